@@ -24,6 +24,8 @@
 import copy
 import gettext
 import logging
+import threading
+import time
 
 # types
 from typing import Any, List
@@ -34,6 +36,8 @@ import numpy
 # local libraries
 from nion.swift.model import HardwareSource
 
+from . import metrics
+
 _ = gettext.gettext
 
 AUTOSTEM_CONTROLLER_ID = "autostem_controller"
@@ -53,13 +57,85 @@ class CameraFrameParameters(object):
         }
 
 
+class AutostemMetadataProvider:
+    """Caches the autostem instrument and a snapshot of its properties.
+
+    The snapshot is refreshed when the instrument reports a property change (if it has a property_changed_event) and
+    at the latest after ttl seconds. All frames share the same snapshot dict, it must not be modified.
+    """
+
+    def __init__(self, instrument_id=AUTOSTEM_CONTROLLER_ID, ttl=10.0):
+        self.instrument_id = instrument_id
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__instrument = None
+        self.__listener = None
+        self.__snapshot = None
+        self.__snapshot_time = None
+        self.__lookup_time = None
+
+    def close(self):
+        with self.__lock:
+            self.__release_instrument()
+
+    def invalidate(self, *args) -> None:
+        self.__snapshot_time = None
+
+    def __release_instrument(self):
+        if self.__listener:
+            self.__listener.close()
+        self.__listener = None
+        self.__instrument = None
+
+    @property
+    def instrument(self):
+        now = time.monotonic()
+        # an instrument that is not there yet is looked up again once per ttl, not on every frame
+        if self.__instrument is None and (self.__lookup_time is None or now - self.__lookup_time > self.ttl):
+            self.__lookup_time = now
+            instrument = HardwareSource.HardwareSourceManager().get_instrument_by_id(self.instrument_id)
+            if instrument:
+                self.__instrument = instrument
+                property_changed_event = getattr(instrument, "property_changed_event", None)
+                if property_changed_event is not None:
+                    self.__listener = property_changed_event.listen(self.invalidate)
+        return self.__instrument
+
+    def get_metadata(self) -> dict:
+        """Return the shared snapshot {"autostem": ..., "extra_high_tension": ...}, empty without autostem."""
+        with self.__lock:
+            now = time.monotonic()
+            if self.__snapshot is not None and self.__snapshot_time is not None and now - self.__snapshot_time <= self.ttl:
+                return self.__snapshot
+            autostem = self.instrument
+            snapshot = dict()
+            if autostem:
+                try:
+                    autostem_properties = autostem.get_autostem_properties()
+                    snapshot["autostem"] = copy.copy(autostem_properties)
+                    # TODO: file format: remove extra_high_tension
+                    high_tension_v = autostem_properties.get("high_tension_v")
+                    if high_tension_v:
+                        snapshot["extra_high_tension"] = high_tension_v
+                except Exception as e:
+                    print(e)
+                    # the instrument may have gone away, look it up again next time
+                    self.__release_instrument()
+                    self.__lookup_time = None
+            self.__snapshot = snapshot
+            self.__snapshot_time = now
+            return snapshot
+
+
 class CameraAcquisitionTask:
 
-    def __init__(self, hardware_source_id, is_continuous: bool, camera, frame_parameters, display_name):
+    def __init__(self, hardware_source_id, is_continuous: bool, camera, frame_parameters, display_name,
+                 metadata_provider=None):
         self.hardware_source_id = hardware_source_id
         self.is_continuous = is_continuous
         self.__camera = camera
         self.__display_name = display_name
+        self.__metadata_provider = metadata_provider or AutostemMetadataProvider()
         self.__frame_parameters = None
         self.__pending_frame_parameters = copy.copy(frame_parameters)
 
@@ -98,7 +174,9 @@ class CameraAcquisitionTask:
         #sub_area = (0, 0), data_element["data"].shape
         data_element["version"] = 1
         #data_element["sub_area"] = sub_area
-        data_element["state"] = "complete"
+        # in sweep mode the camera marks frames that only changed a sub_area as partial, a sweep is complete when the
+        # buffer starts over
+        data_element.setdefault("state", "complete")
         # add optional calibration properties
         if "spatial_calibrations" in data_element["properties"]:
             data_element["spatial_calibrations"] = data_element["properties"]["spatial_calibrations"]
@@ -107,17 +185,9 @@ class CameraAcquisitionTask:
         if "intensity_calibration" in data_element["properties"]:
             data_element["intensity_calibration"] = data_element["properties"]["intensity_calibration"]
         # grab metadata from the autostem
-        autostem = HardwareSource.HardwareSourceManager().get_instrument_by_id(AUTOSTEM_CONTROLLER_ID)
-        if autostem:
-            try:
-                autostem_properties = autostem.get_autostem_properties()
-                data_element["properties"]["autostem"] = copy.copy(autostem_properties)
-                # TODO: file format: remove extra_high_tension
-                high_tension_v = autostem_properties.get("high_tension_v")
-                if high_tension_v:
-                    data_element["properties"]["extra_high_tension"] = high_tension_v
-            except Exception as e:
-                print(e)
+        start = metrics.clock()
+        data_element["properties"].update(self.__metadata_provider.get_metadata())
+        metrics.METADATA.observe_since(start)
 
         data_element["properties"]["hardware_source_name"] = self.__display_name
         data_element["properties"]["hardware_source_id"] = self.hardware_source_id
@@ -149,6 +219,7 @@ class CameraAdapter:
         self.processor = None
         self.on_selected_profile_index_changed = None
         self.on_profile_frame_parameters_changed = None
+        self.metadata_provider = AutostemMetadataProvider()
 
         def low_level_parameter_changed(parameter_name):
             profile_index = self.camera.mode_as_index
@@ -168,6 +239,7 @@ class CameraAdapter:
     def close(self):
         # unlisten for events from the image panel
         self.camera.on_low_level_parameter_changed = None
+        self.metadata_provider.close()
         self.camera.close()
 
     def get_initial_profiles(self) -> List[Any]:
@@ -208,18 +280,27 @@ class CameraAdapter:
         return self.camera.get_expected_dimensions(binning)
 
     def create_acquisition_task(self, frame_parameters):
-        acquisition_task = CameraAcquisitionTask(self.hardware_source_id, True, self.camera, frame_parameters, self.display_name)
+        acquisition_task = CameraAcquisitionTask(self.hardware_source_id, True, self.camera, frame_parameters, self.display_name, self.metadata_provider)
         return acquisition_task
 
     def create_record_task(self, frame_parameters):
-        record_task = CameraAcquisitionTask(self.hardware_source_id, False, self.camera, frame_parameters, self.display_name)
+        record_task = CameraAcquisitionTask(self.hardware_source_id, False, self.camera, frame_parameters, self.display_name, self.metadata_provider)
         return record_task
 
     def acquire_sequence(self, frame_parameters, n: int):
         mode_id = self.camera.mode
         self.camera.set_exposure_ms(frame_parameters.exposure_ms, mode_id)
         self.camera.set_binning(frame_parameters.binning, mode_id)
-        return self.camera.acquire_sequence(n)
+        data_element = self.camera.acquire_sequence(n)
+        data_element["version"] = 1
+        data_element["state"] = "complete"
+        data_element["spatial_calibrations"] = data_element["properties"]["spatial_calibrations"]
+        data_element["intensity_calibration"] = data_element["properties"]["intensity_calibration"]
+        data_element["properties"]["hardware_source_name"] = self.display_name
+        data_element["properties"]["hardware_source_id"] = self.hardware_source_id
+        data_element["properties"]["exposure"] = frame_parameters.exposure_ms / 1000.0
+        data_element["properties"]["binning"] = frame_parameters.binning
+        return data_element
 
     def open_configuration_interface(self):
         self.camera.show_config_window()
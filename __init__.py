@@ -21,24 +21,55 @@
 #SOFTWARE.
 
 # standard libraries
+import os
 try:
     from nion.swift.model import HardwareSource
     from Camera import CameraHardwareSource
 except:
     pass
 from . import quartzcam
+from . import multi
+from . import metrics
 from . import QuartzCameraManagerImageSource
 
+camera_map = dict()
 
-def register_camera(hardware_source_id, display_name):
+
+def register_camera(hardware_source_id, display_name, camera=None):
     # create the camera
-    camera = quartzcam.Camera()
-    #camera_map[hardware_source_id] = camera
+    if camera is None:
+        camera = quartzcam.Camera()
+    camera_map[hardware_source_id] = camera
     # create the hardware source
     camera_adapter = QuartzCameraManagerImageSource.CameraAdapter(hardware_source_id, display_name, camera)
     hardware_source = CameraHardwareSource.CameraHardwareSource(camera_adapter, None)
     hardware_source.modes = camera_adapter.modes
     # register it with the manager
     HardwareSource.HardwareSourceManager().register_hardware_source(hardware_source)
-                
-register_camera('quartzcam', 'QPod')
\ No newline at end of file
+
+
+def register_cameras(serialports=None, combined=True):
+    """ registers one hardware source per QPOD and optionally one showing all channels (serialports=None discovers
+    the controllers) """
+    manager = multi.QPODManager(serialports)
+    cameras = manager.open()
+    for i, camera in enumerate(cameras):
+        # the first channel keeps the id of the single controller setup, so the panel keeps working
+        hardware_source_id = 'quartzcam' if i == 0 else 'quartzcam{:d}'.format(i+1)
+        register_camera(hardware_source_id, 'QPod {:d}'.format(i+1), camera)
+    if combined and len(cameras) > 1:
+        register_camera('quartzcam_all', 'QPod (all channels)', multi.MultiCamera(manager))
+    return manager
+
+# QUARTZPY_SERIAL_PORTS selects several controllers, separated by os.pathsep, or 'auto' to discover them
+serialports = os.environ.get('QUARTZPY_SERIAL_PORTS')
+if serialports:
+    register_cameras(None if serialports == 'auto' else serialports.split(os.pathsep))
+else:
+    register_camera('quartzcam', 'QPod')
+
+# QUARTZPY_METRICS_FILE dumps the acquisition metrics every 10 s, as JSON if the name ends with .json, otherwise in
+# the Prometheus text format
+metrics_file = os.environ.get('QUARTZPY_METRICS_FILE')
+if metrics_file:
+    metrics.REGISTRY.start_export(metrics_file, format='json' if metrics_file.endswith('.json') else 'prometheus')
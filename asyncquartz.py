@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio client for the QPOD controller.
+
+AsyncQPOD uses the same protocol helpers and conversions as quartz.QPOD, but the serial port is opened non-blocking
+and watched by the event loop (loop.add_reader), so one loop can serve many controllers without a thread per device:
+
+    qp = asyncquartz.AsyncQPOD()
+    await qp.openconnection('/dev/ttyUSB0')
+    print(await qp.readthickness())
+    async for timestamp, counts, frequency in qp.readings(interval=0.1):
+        ...
+
+This needs a port with a file descriptor (a serial device or pty) and an event loop that supports add_reader, which
+excludes the Windows proactor loop.
+"""
+
+import asyncio
+import collections
+import serial
+
+try:
+    from . import quartz
+except ImportError:
+    # imported as a plain module like 'python quartz.py' does
+    import quartz
+
+
+class AsyncQPOD(quartz.QPODBase):
+    """ Class for managing the QPOD controller from an asyncio event loop """
+    def __init__(self):
+        super().__init__()
+        self.ser = None
+        self._loop = None
+        self._buffer = b''
+        self._pending = collections.deque()
+        # deadline for every command in s, None waits forever
+        self.timeout = 1.0
+        # set after a timeout, answers that arrive late are discarded before the next request
+        self._stale = False
+        self._subscribers = set()
+        self._poll_task = None
+        # set while a changed gate period settles
+        self._settling = None
+
+    async def openconnection(self, serialport='/dev/ttyUSB0'):
+        """ open serial connection to QPOD controller """
+        self._loop = asyncio.get_running_loop()
+        self.ser = serial.serial_for_url(
+            serialport,
+            baudrate=115200,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            bytesize=serial.EIGHTBITS,
+            timeout=0
+        )
+        # discard answers that are still in flight from a previous session
+        self.ser.reset_input_buffer()
+        self._loop.add_reader(self.ser.fileno(), self._data_received)
+        await self.comm_many(self.setup_commands())
+
+    async def closeconnection(self):
+        """ close serial connection to QPOD """
+        await self.stop_polling()
+        if self.ser is not None:
+            self._loop.remove_reader(self.ser.fileno())
+            self.ser.close()
+            self.ser = None
+        self._fail_pending(ConnectionError('QPOD connection closed.'))
+
+    def _fail_pending(self, exception):
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(exception)
+
+    def _data_received(self):
+        try:
+            data = self.ser.read(4096)
+        except Exception as e:
+            # the port is gone, as long as the reader is registered the loop would call this again right away
+            self._loop.remove_reader(self.ser.fileno())
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+            self.ser = None
+            self._fail_pending(ConnectionError('Connection to QPOD lost. Reason: {}'.format(str(e))))
+            return
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            # answers arrive in the order of the requests, futures of timed out requests are skipped
+            if self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(line + b'\n')
+
+    def _send(self, commands):
+        if self.ser is None:
+            raise ConnectionError('Not connected to QPOD.')
+        if self._stale:
+            self.ser.reset_input_buffer()
+            self._buffer = b''
+            self._stale = False
+        futures = [self._loop.create_future() for command in commands]
+        self._pending.extend(futures)
+        self.ser.write(b''.join(quartz.format_command(command) for command in commands))
+        return futures
+
+    async def _request(self, commands, timeout):
+        # answers are matched to the requests by their order, so after a timeout nothing that is in flight can be
+        # trusted: the pending requests fail and late answers are discarded like in quartz.QPOD._check_answer
+        if timeout is None:
+            timeout = self.timeout
+        answers = asyncio.gather(*self._send(commands))
+        # the answers of a cancelled request are not needed, this keeps asyncio from warning about them
+        answers.add_done_callback(lambda future: future.cancelled() or future.exception())
+        try:
+            return await asyncio.wait_for(answers, timeout)
+        except asyncio.TimeoutError:
+            self._buffer = b''
+            self._stale = True
+            error = quartz.QPODTimeoutError('No answer from QPOD within {:g} s.'.format(timeout))
+            self._fail_pending(error)
+            raise error from None
+
+    async def comm(self, command='A1', timeout=None):
+        """ reads answer from QPOD, raises a quartz.QPODTimeoutError if it does not arrive within timeout s (default
+        self.timeout) """
+        answer, = await self._request([command], timeout)
+        return answer
+
+    async def comm_many(self, commands, timeout=None):
+        """ sends several commands in one write and returns their answers in order """
+        return await self._request(commands, timeout)
+
+    async def set_periods(self, gateperiod=None, measurementperiod=None):
+        """ changes gate and/or measurement period, see quartz.QPOD.set_periods """
+        gateperiod, measurementperiod = self.check_periods(gateperiod or self.gateperiod,
+                                                           measurementperiod or self.measurementperiod)
+        settle_time = self.measurement_time + int(measurementperiod) / quartz.CLOCK_HZ
+        # readings wait until the first measurement with the new gate is complete, stop_polling may reset
+        # self._settling meanwhile, so the event is kept here
+        settling = self._settling = asyncio.Event()
+        try:
+            await self.comm_many(['B' + gateperiod, 'C' + measurementperiod])
+            await asyncio.sleep(settle_time)
+            self.gateperiod = gateperiod
+            self.measurementperiod = measurementperiod
+        finally:
+            if self._settling is settling:
+                self._settling = None
+            settling.set()
+
+    @property
+    def settling(self):
+        return self._settling is not None
+
+    async def readcounts(self):
+        """ reads the raw gate count from QPOD """
+        if self._settling is not None:
+            await self._settling.wait()
+        return quartz.parse_counts(await self.comm('A1'))
+
+    async def readsample(self):
+        """ returns a (timestamp, raw count, frequency) tuple """
+        counts = await self.readcounts()
+        return (self.clock(), counts, self.frequency(counts))
+
+    async def readthickness(self, return_freq=False):
+        freq = self.frequency(await self.readcounts())
+        thickness = self.thickness(freq)
+        if return_freq:
+            return (thickness, freq)
+        else:
+            return thickness
+
+    def start_polling(self, interval=0):
+        """ starts a task that samples QPOD and hands every sample to all readings() iterators """
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = self._loop.create_task(self._poll_loop(interval))
+
+    async def stop_polling(self):
+        task = self._poll_task
+        if task is not None:
+            # before Python 3.12 wait_for swallows a cancellation that coincides with an answer, so it is repeated
+            while not task.done():
+                task.cancel()
+                await asyncio.wait([task], timeout=0.1)
+            self._poll_task = None
+        self._settling = None
+
+    def _publish(self, item):
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    async def _poll_loop(self, interval):
+        while True:
+            try:
+                sample = await self.readsample()
+            except (ValueError, quartz.QPODTimeoutError) as e:
+                # missing or garbled answers are retried
+                print("Polling QPOD failed. Reason: {}".format(str(e)))
+                await asyncio.sleep(1)
+                continue
+            except OSError as e:
+                # the port failed (serial.SerialException and ConnectionError are OSErrors), the readings() iterators
+                # end with the error instead of waiting forever
+                print("Polling QPOD stopped. Reason: {}".format(str(e)))
+                self._publish(e)
+                return
+            self._publish(sample)
+            if interval > 0:
+                await asyncio.sleep(interval)
+
+    async def readings(self, interval=0, maxsize=1000):
+        """ async iterator of (timestamp, raw count, frequency) samples
+
+        All iterators share one polling task (started with the interval of the first one), so adding consumers does
+        not add serial traffic. A consumer that falls more than maxsize samples behind loses the oldest ones. When the
+        serial port fails, the iterators raise the error.
+        """
+        queue = asyncio.Queue(maxsize)
+        self._subscribers.add(queue)
+        self.start_polling(interval)
+        try:
+            while True:
+                sample = await queue.get()
+                if isinstance(sample, Exception):
+                    raise sample
+                yield sample
+        finally:
+            self._subscribers.discard(queue)
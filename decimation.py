@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decimation of long thickness histories for display.
+
+Both methods reduce a window to at most n_points samples and keep peaks, so the cost of shipping and drawing a frame
+stays bounded independent of the window length.
+"""
+
+import numpy as np
+
+
+def minmax(values, n_points):
+    """ keeps the minimum and the maximum of each of n_points // 2 equally sized bins, in the order they occur """
+    values = np.asarray(values)
+    n_bins = max(n_points // 2, 1)
+    if len(values) <= n_points:
+        return np.array(values, dtype=np.float32)
+    bin_size = -(-len(values) // n_bins)
+    n_full = len(values) // bin_size
+    bins = values[:n_full*bin_size].reshape(n_full, bin_size)
+    rows = np.arange(n_full)
+    argmin = np.argmin(bins, axis=1)
+    argmax = np.argmax(bins, axis=1)
+    first = np.where(argmin < argmax, argmin, argmax)
+    second = np.where(argmin < argmax, argmax, argmin)
+    tail = values[n_full*bin_size:]
+    result = np.empty(2*n_full + (2 if len(tail) else 0), dtype=np.float32)
+    result[0:2*n_full:2] = bins[rows, first]
+    result[1:2*n_full:2] = bins[rows, second]
+    if len(tail):
+        result[-2:] = (tail.min(), tail.max()) if np.argmin(tail) < np.argmax(tail) else (tail.max(), tail.min())
+    return result
+
+
+def bin_mean(timestamps, values, n):
+    """ averages consecutive groups of n samples, returns (timestamps, means, standard deviations)
+
+    Samples that do not fill a complete group are dropped, the caller has to keep them for the next call.
+    """
+    n_full = len(values) // n
+    timestamps = np.asarray(timestamps[:n_full*n], dtype=np.float64).reshape(n_full, n)
+    values = np.asarray(values[:n_full*n], dtype=np.float64).reshape(n_full, n)
+    return timestamps.mean(axis=1), values.mean(axis=1), values.std(axis=1)
+
+
+def lttb(timestamps, values, n_points):
+    """ largest-triangle-three-buckets downsampling to n_points samples, returns (timestamps, values) """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values)
+    n = len(values)
+    if n <= n_points or n_points < 3:
+        return np.array(timestamps), np.array(values, dtype=np.float32)
+    edges = np.linspace(1, n - 1, n_points - 1).astype(np.intp)
+    # averages of all buckets at once, the selection below only depends on the previously selected point
+    sums = np.add.reduceat(values[1:n-1].astype(np.float64), edges[:-1] - 1)
+    t_sums = np.add.reduceat(timestamps[1:n-1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    t_mean = np.append(t_sums / counts, timestamps[-1])
+    v_mean = np.append(sums / counts, values[-1])
+    selected = np.empty(n_points, dtype=np.intp)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_points - 2):
+        start, stop = edges[i], edges[i+1]
+        t_a, v_a = timestamps[a], values[a]
+        areas = np.abs((t_a - t_mean[i+1]) * (values[start:stop] - v_a) -
+                       (t_a - timestamps[start:stop]) * (v_mean[i+1] - v_a))
+        a = start + int(np.argmax(areas))
+        selected[i+1] = a
+    return timestamps[selected], values[selected].astype(np.float32)
+
+
+METHODS = ('minmax', 'lttb')
+
+
+def decimate(timestamps, values, n_points, method='minmax'):
+    """ reduces a window to at most n_points samples with one of METHODS, returns (timestamps, values)
+
+    For minmax the returned timestamps are the bin edges spread evenly over the window.
+    """
+    if method == 'lttb':
+        return lttb(timestamps, values, n_points)
+    if method != 'minmax':
+        raise ValueError('Unknown decimation method {}, use one of {}.'.format(method, ', '.join(METHODS)))
+    decimated = minmax(values, n_points)
+    return np.linspace(timestamps[0], timestamps[-1], len(decimated)), decimated
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixed-capacity sample history for the quartz camera.
+"""
+
+import numpy as np
+
+
+class ThicknessHistory(object):
+    """ Ring buffer of (timestamp, value, error, frequency) samples backed by numpy arrays.
+
+    The samples live in a linear buffer of twice the capacity. New samples are appended at the end and once the
+    buffer is full the most recent `capacity` samples are moved back to the front. This keeps the live region
+    contiguous, so windows can always be returned as views, and appending stays O(1) amortized.
+    """
+    def __init__(self, capacity=2**20):
+        capacity = int(capacity)
+        if capacity < 2:
+            raise ValueError('History capacity must be at least 2, got {:d}.'.format(capacity))
+        self.capacity = capacity
+        self._timestamps = np.empty(2*capacity, dtype=np.float64)
+        self._values = np.empty(2*capacity, dtype=np.float32)
+        # spread of the raw readings that were averaged into each value, 0 for unbinned samples
+        self._errors = np.empty(2*capacity, dtype=np.float32)
+        # raw crystal frequency of each value, so the values can be recomputed with other conversion parameters
+        self._frequencies = np.empty(2*capacity, dtype=np.float64)
+        self._start = 0
+        self._end = 0
+        # number of samples appended since the history was created, the sample at index i was the
+        # (written - len(self) + i)-th one
+        self.written = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def timestamps(self):
+        return self._timestamps[self._start:self._end]
+
+    @property
+    def values(self):
+        return self._values[self._start:self._end]
+
+    @property
+    def errors(self):
+        return self._errors[self._start:self._end]
+
+    @property
+    def frequencies(self):
+        return self._frequencies[self._start:self._end]
+
+    def clear(self):
+        self._start = 0
+        self._end = 0
+
+    def _make_room(self, n):
+        # Returns the index at which n new samples can be written
+        if self._end + n > len(self._timestamps):
+            keep = min(len(self), self.capacity - n)
+            if keep > 0:
+                self._timestamps[:keep] = self._timestamps[self._end-keep:self._end]
+                self._values[:keep] = self._values[self._end-keep:self._end]
+                self._errors[:keep] = self._errors[self._end-keep:self._end]
+                self._frequencies[:keep] = self._frequencies[self._end-keep:self._end]
+            self._start = 0
+            self._end = keep
+        return self._end
+
+    def append(self, timestamp, value, error=0, frequency=np.nan):
+        index = self._make_room(1)
+        self._timestamps[index] = timestamp
+        self._values[index] = value
+        self._errors[index] = error
+        self._frequencies[index] = frequency
+        self._end = index + 1
+        self.written += 1
+        if self._end - self._start > self.capacity:
+            self._start = self._end - self.capacity
+
+    def extend(self, timestamps, values, errors=None, frequencies=None):
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float32)
+        if errors is None:
+            errors = 0
+        errors = np.broadcast_to(np.asarray(errors, dtype=np.float32), values.shape)
+        if frequencies is None:
+            frequencies = np.nan
+        frequencies = np.broadcast_to(np.asarray(frequencies, dtype=np.float64), values.shape)
+        if len(timestamps) != len(values):
+            raise ValueError('timestamps and values must have the same length.')
+        self.written += len(timestamps)
+        if len(timestamps) > self.capacity:
+            timestamps = timestamps[-self.capacity:]
+            values = values[-self.capacity:]
+            errors = errors[-self.capacity:]
+            frequencies = frequencies[-self.capacity:]
+        n = len(timestamps)
+        if n == 0:
+            return
+        index = self._make_room(n)
+        self._timestamps[index:index+n] = timestamps
+        self._values[index:index+n] = values
+        self._errors[index:index+n] = errors
+        self._frequencies[index:index+n] = frequencies
+        self._end = index + n
+        if self._end - self._start > self.capacity:
+            self._start = self._end - self.capacity
+
+    def index_at(self, timestamp):
+        """ returns the index of the sample closest to timestamp (binary search) """
+        timestamps = self.timestamps
+        index = int(np.searchsorted(timestamps, timestamp))
+        if index >= len(timestamps):
+            return len(timestamps) - 1
+        if index > 0 and timestamp - timestamps[index-1] <= timestamps[index] - timestamp:
+            return index - 1
+        return index
+
+    def window(self, time_to_show, now=None, with_errors=False):
+        """ returns views on (timestamps, values) covering the last time_to_show seconds
+
+        A time_to_show <= 0 returns the full history. The window starts at the sample closest to now - time_to_show.
+        With with_errors=True the errors are returned as a third array. The returned arrays are views and are only
+        valid until the next append.
+        """
+        timestamps = self.timestamps
+        if len(timestamps) == 0:
+            return (timestamps, self.values, self.errors) if with_errors else (timestamps, self.values)
+        if now is None:
+            now = timestamps[-1]
+        if time_to_show > 0 and timestamps[0] < now - time_to_show:
+            start_index = self.index_at(now - time_to_show)
+        else:
+            start_index = 0
+        if with_errors:
+            return timestamps[start_index:], self.values[start_index:], self.errors[start_index:]
+        return timestamps[start_index:], self.values[start_index:]
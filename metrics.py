@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Low-overhead timing and counters for the acquisition path.
+
+Stages are timed with integer nanosecond clocks into log2-bucketed histograms, so a probe costs a clock read, a
+bit_length and a few integer additions:
+
+    start = metrics.clock()
+    ...
+    metrics.SERIAL.observe_since(start)
+
+Updates are not locked. Under heavy contention a few increments may be lost, which is acceptable for monitoring and
+keeps probes well below a microsecond. All metrics can be read with REGISTRY.snapshot() or written periodically to a
+Prometheus text or JSON file with REGISTRY.start_export().
+"""
+
+import os
+import json
+import time
+import threading
+
+clock = time.perf_counter_ns
+
+# bucket i holds durations of i bits, i.e. from 2**(i-1) to 2**i - 1 ns
+N_BUCKETS = 64
+# bucket range written to the Prometheus export, about 1 us to 34 s
+EXPORT_BUCKETS = range(10, 36)
+
+
+class Histogram(object):
+    """ Latency histogram with power of two nanosecond buckets """
+    __slots__ = ('name', 'registry', 'counts', 'count', 'total_ns', 'max_ns')
+
+    def __init__(self, name, registry):
+        self.name = name
+        self.registry = registry
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * N_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def observe(self, ns):
+        if self.registry.enabled:
+            self.counts[ns.bit_length()] += 1
+            self.count += 1
+            self.total_ns += ns
+            if ns > self.max_ns:
+                self.max_ns = ns
+
+    def observe_since(self, start):
+        ns = clock() - start
+        if self.registry.enabled:
+            self.counts[ns.bit_length()] += 1
+            self.count += 1
+            self.total_ns += ns
+            if ns > self.max_ns:
+                self.max_ns = ns
+
+    def percentile(self, q):
+        """ returns an upper bound of the q-th percentile in s (the upper edge of its bucket) """
+        if self.count == 0:
+            return None
+        threshold = q / 100 * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= threshold:
+                return min(2**i, self.max_ns) * 1e-9
+        return self.max_ns * 1e-9
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum_s': self.total_ns * 1e-9,
+                'mean_s': self.total_ns * 1e-9 / self.count if self.count else None,
+                'max_s': self.max_ns * 1e-9,
+                'p50_s': self.percentile(50),
+                'p99_s': self.percentile(99),
+                'buckets': list(self.counts)}
+
+
+class Counter(object):
+    __slots__ = ('name', 'registry', 'value')
+
+    def __init__(self, name, registry):
+        self.name = name
+        self.registry = registry
+        self.value = 0
+
+    def reset(self):
+        self.value = 0
+
+    def add(self, n=1):
+        if self.registry.enabled:
+            self.value += n
+
+
+class Metrics(object):
+    """ Registry of named stage histograms and counters """
+    def __init__(self, prefix='qpod', enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.stages = dict()
+        self.counters = dict()
+        self._export_thread = None
+        self._export_stop = threading.Event()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Histogram(name, self)
+        return self.stages[name]
+
+    def counter(self, name):
+        if name not in self.counters:
+            self.counters[name] = Counter(name, self)
+        return self.counters[name]
+
+    def reset(self):
+        for metric in list(self.stages.values()) + list(self.counters.values()):
+            metric.reset()
+
+    def snapshot(self):
+        return {'timestamp': time.time(),
+                'stages': {name: stage.snapshot() for name, stage in self.stages.items()},
+                'counters': {name: counter.value for name, counter in self.counters.items()}}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    def to_prometheus(self):
+        lines = ['# TYPE {}_stage_seconds histogram'.format(self.prefix)]
+        for name, stage in self.stages.items():
+            counts = list(stage.counts)
+            for i in EXPORT_BUCKETS:
+                lines.append('{}_stage_seconds_bucket{{stage="{}",le="{:.9g}"}} {:d}'.format(
+                    self.prefix, name, 2**i * 1e-9, sum(counts[:i+1])))
+            lines.append('{}_stage_seconds_bucket{{stage="{}",le="+Inf"}} {:d}'.format(self.prefix, name, sum(counts)))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {:.9g}'.format(self.prefix, name, stage.total_ns * 1e-9))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {:d}'.format(self.prefix, name, sum(counts)))
+        for name, counter in self.counters.items():
+            lines.append('# TYPE {}_{}_total counter'.format(self.prefix, name))
+            lines.append('{}_{}_total {:d}'.format(self.prefix, name, counter.value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, format='prometheus'):
+        """ writes the metrics to path, replacing the file atomically """
+        text = self.to_json() if format == 'json' else self.to_prometheus()
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    def start_export(self, path, interval=10.0, format='prometheus'):
+        """ dumps the metrics to path every interval seconds ('prometheus' or 'json' format) """
+        self.stop_export()
+        self._export_stop.clear()
+        self._export_thread = threading.Thread(target=self._export_loop, args=(path, interval, format),
+                                               name='QPOD metrics export', daemon=True)
+        self._export_thread.start()
+
+    def stop_export(self):
+        self._export_stop.set()
+        if self._export_thread is not None:
+            self._export_thread.join()
+        self._export_thread = None
+
+    def _export_loop(self, path, interval, format):
+        while not self._export_stop.wait(interval):
+            try:
+                self.dump(path, format)
+            except Exception as e:
+                print("Could not export metrics. Reason: {}".format(str(e)))
+
+
+REGISTRY = Metrics()
+
+# stages of the acquisition path
+SERIAL = REGISTRY.stage('serial_roundtrip')
+CONVERSION = REGISTRY.stage('conversion')
+HISTORY = REGISTRY.stage('history')
+METADATA = REGISTRY.stage('metadata')
+UI_CALLBACK = REGISTRY.stage('ui_callback')
+FRAME = REGISTRY.stage('frame')
+
+SAMPLES = REGISTRY.counter('samples')
+FRAMES = REGISTRY.counter('frames')
+FRAME_OVERRUNS = REGISTRY.counter('frame_overruns')
+DROPPED_RESPONSES = REGISTRY.counter('dropped_responses')
+BYTES_WRITTEN = REGISTRY.counter('serial_bytes_written')
+BYTES_READ = REGISTRY.counter('serial_bytes_read')
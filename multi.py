@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Support for several QPOD controllers (crystal heads) at once.
+
+QPODManager opens any number of controllers and polls them concurrently from one thread pool, so a polling cycle
+takes as long as the slowest controller instead of the sum of all of them. Every controller gets its own
+quartzcam.Camera and MultiCamera combines them into one (channels, samples) source.
+"""
+
+import glob
+import time
+import fnmatch
+import threading
+import concurrent.futures
+import numpy as np
+
+from . import quartz
+from . import quartzcam
+from . import pacing
+
+
+def discover_ports(patterns=('/dev/ttyUSB*', '/dev/ttyACM*')):
+    """ returns the serial ports that may have a QPOD connected """
+    try:
+        from serial.tools import list_ports
+        ports = [port.device for port in list_ports.comports()]
+    except ImportError:
+        ports = []
+    ports = [port for port in ports if any(fnmatch.fnmatch(port, pattern) for pattern in patterns)]
+    if not ports:
+        ports = [port for pattern in patterns for port in glob.glob(pattern)]
+    return sorted(set(ports))
+
+
+class QPODManager(object):
+    """ Opens and polls several QPOD controllers
+
+    serialports: list of ports, None discovers them with discover_ports
+    poll_interval: interval of the polling loop in s, 0 polls at the measurement rate of the slowest controller
+    """
+    def __init__(self, serialports=None, poll_interval=0, max_workers=None):
+        if serialports is None:
+            serialports = discover_ports()
+        self.serialports = list(serialports)
+        self.qpods = [quartz.QPOD() for port in self.serialports]
+        self.poll_interval = poll_interval
+        self.cameras = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or max(len(self.qpods), 1),
+                                                               thread_name_prefix='QPOD manager')
+        # controllers that have polling started
+        self.polled = set()
+        self._poll_thread = None
+        self._poll_stop = threading.Event()
+
+    def __len__(self):
+        return len(self.qpods)
+
+    def open(self):
+        """ creates one Camera per controller
+
+        The cameras connect lazily in the background on their first start_live, so the controllers are opened
+        concurrently. Use connect() to open all of them right away.
+        """
+        for qpod in self.qpods:
+            qpod.poller = self
+        self.cameras = [quartzcam.Camera(poll_interval=self.poll_interval, serialport=serialport, qpod=qpod)
+                        for qpod, serialport in zip(self.qpods, self.serialports)]
+        return self.cameras
+
+    def connect(self, timeout=None):
+        """ connects all cameras concurrently and waits for them """
+        for camera in self.cameras:
+            camera.connect()
+        for camera in self.cameras:
+            camera.wait_connected(timeout)
+
+    def close(self):
+        self.stop_polling()
+        for qpod in self.qpods:
+            qpod.poller = None
+            try:
+                qpod.closeconnection()
+            except Exception as e:
+                print("Could not close QPOD connection. Reason: {}".format(str(e)))
+        self._executor.shutdown(wait=False)
+
+    def set_parameters(self, channel, density=None, z_ratio=None):
+        """ sets density and/or z_ratio of one channel, the history of its camera is recomputed """
+        self.cameras[channel].set_parameters(density, z_ratio)
+
+    def readsamples(self):
+        """ reads one sample from every controller concurrently, returns a list of (timestamp, counts, frequency) """
+        futures = [self._executor.submit(qpod.readsample) for qpod in self.qpods]
+        return [future.result() for future in futures]
+
+    @property
+    def polling(self):
+        return self._poll_thread is not None and self._poll_thread.is_alive()
+
+    def start_polling(self, interval=None, qpods=None):
+        """ polls the controllers qpods (default: all) in a background loop and fills the sample queue of each QPOD
+
+        Each cycle waits for the slowest controller before the next one starts, so all channels are sampled at the
+        same rate. The loop runs until polling was stopped for all controllers.
+        """
+        self.polled.update(self.qpods if qpods is None else qpods)
+        if self.polling:
+            return
+        if interval is None:
+            interval = self.poll_interval
+        self._poll_stop.clear()
+        self._poll_thread = threading.Thread(target=self._poll_loop, args=(interval,), name='QPOD manager polling',
+                                             daemon=True)
+        self._poll_thread.start()
+
+    def stop_polling(self, timeout=5, qpods=None):
+        """ stops polling the controllers qpods (default: all) """
+        self.polled.difference_update(self.qpods if qpods is None else qpods)
+        if self.polled:
+            return
+        self._poll_stop.set()
+        if self._poll_thread is not None:
+            self._poll_thread.join(timeout)
+        self._poll_thread = None
+
+    def _poll_loop(self, interval):
+        while not self._poll_stop.is_set():
+            starttime = time.time()
+            # controllers that are still connecting are skipped
+            qpods = [qpod for qpod in self.qpods if qpod in self.polled and qpod.connected]
+            if not qpods:
+                self._poll_stop.wait(0.1)
+                continue
+            if interval > 0:
+                period = interval
+            else:
+                # readings faster than the measurement period only repeat the same measurement
+                period = max(qpod.measurement_time for qpod in qpods)
+            futures = [self._executor.submit(qpod.readsample) for qpod in qpods]
+            for qpod, future in zip(qpods, futures):
+                try:
+                    qpod.samples.put(future.result())
+                except quartz.QPODSettlingError:
+                    pass
+                except Exception as e:
+                    print("Polling QPOD failed. Reason: {}".format(str(e)))
+            self._poll_stop.wait(max(period - (time.time() - starttime), 0))
+
+
+class MultiCamera(object):
+    """ Camera interface showing all channels of a QPODManager as one (channels, samples) array
+
+    The channels are resampled onto a common time grid because the controllers are not read at exactly the same
+    instants.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.cameras = manager.cameras
+        self.time_to_show = 300 #s
+        self.mode = 'Run'
+        self.mode_as_index = 0
+        self.exposures_ms = {'Run': 1000, 'Tune': 200, 'Snap': 1000}
+        self.frame_scheduler = pacing.FrameScheduler()
+        self.binning = 1
+        self.sensor_dimensions = (len(self.cameras), 512)
+        self.readout_area = self.sensor_dimensions
+        self.binning_values = [1]
+        self.frame_number = 0
+        self.starttime = min(camera.starttime for camera in self.cameras)
+
+    @property
+    def exposure_ms(self):
+        return self.exposures_ms.get(self.mode, 1000)
+
+    def set_exposure_ms(self, exposure_ms, mode_id):
+        self.exposures_ms[mode_id] = exposure_ms
+
+    def get_exposure_ms(self, mode_id):
+        return self.exposures_ms.get(mode_id, 1000)
+
+    def set_binning(self, binning, mode_id):
+        self.binning = binning
+
+    def get_binning(self, mode_id):
+        return self.binning
+
+    def get_expected_dimensions(self, binning):
+        return self.sensor_dimensions
+
+    def start_live(self):
+        self.frame_scheduler.reset()
+        for camera in self.cameras:
+            camera.connect()
+        self.manager.start_polling()
+
+    def stop_live(self):
+        self.frame_scheduler.cancel()
+        # channels that are live on their own keep polling
+        self.manager.stop_polling(qpods=[camera.quartz for camera in self.cameras if not camera._live])
+
+    def acquire_image(self):
+        data_element = {}
+        data_element['properties'] = {}
+        windows = []
+        connected = []
+        for camera in self.cameras:
+            try:
+                camera.wait_connected()
+            except IOError:
+                connected.append(False)
+            else:
+                connected.append(True)
+        self.frame_scheduler.set_period(self.exposure_ms / 1000)
+        overrun = self.frame_scheduler.wait()
+        for camera, camera_connected in zip(self.cameras, connected):
+            if camera_connected:
+                camera._read_samples()
+            else:
+                camera._add_gap(camera.quartz.clock())
+            windows.append(camera.get_full_resolution_data(self.time_to_show))
+        # the time base of QPOD, which is the recorded time when replaying
+        now = self.cameras[0].quartz.clock()
+        # channels without readings in the window are shown as gaps
+        start_time = min([timestamps[0] for timestamps, values in windows if len(timestamps)], default=now)
+        n = max(max(len(values) for timestamps, values in windows), 1)
+        grid = np.linspace(start_time, now, n)
+        data = np.empty((len(windows), n), dtype=np.float32)
+        for i, (timestamps, values) in enumerate(windows):
+            data[i] = np.interp(grid, timestamps, values) if len(timestamps) else np.nan
+        data_element['data'] = data
+        spatial_calibrations = [{'offset': 0, 'scale': 1, 'units': ''},
+                                {'offset': start_time - self.starttime, 'scale': (now - start_time) / n, 'units': 's'}]
+        data_element['properties']['spatial_calibrations'] = spatial_calibrations
+        data_element['properties']['intensity_calibration'] = {'offset': 0, 'scale': 1, 'units': 'Angstrom'}
+        data_element['properties']['frame_number'] = self.frame_number
+        data_element['properties']['frame_overrun'] = overrun
+        self.frame_number += 1
+
+        return data_element
+
+    def set_zero(self):
+        for camera in self.cameras:
+            camera.set_zero()
+
+    def close(self):
+        self.manager.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deadline-based frame pacing.
+
+Sleeping a fixed time after each frame makes the frame period the sleep time plus the I/O time, so frames drift over
+long runs. FrameScheduler instead lets frames start on a fixed grid t0 + k * period and only sleeps for the time left
+until the next grid point. Every frame that starts late is counted as an overrun. Once a whole slot was missed the
+schedule continues with the next free grid point instead of trying to catch up.
+"""
+
+import time
+import threading
+
+
+class FrameScheduler(object):
+    """ Paces frames on a grid with period s (0 does not pace at all) """
+    def __init__(self, period=1.0):
+        self.period = period
+        self.overruns = 0
+        # time by which the last frame missed its slot in s, 0 if it was on time
+        self.last_overrun = 0
+        self._next = None
+        self._cancel = threading.Event()
+
+    def reset(self):
+        """ starts a new grid at the next call of wait """
+        self._next = None
+        self._cancel.clear()
+
+    def cancel(self):
+        """ makes a pending wait return immediately, e.g. when live view is stopped """
+        self._cancel.set()
+
+    def set_period(self, period):
+        # a new period starts a new grid, otherwise the first frame would be counted as an overrun
+        if period != self.period:
+            self.period = period
+            self._next = None
+
+    def wait(self):
+        """ waits for the next slot of the grid and returns the time by which it was missed in s """
+        now = time.monotonic()
+        if self.period <= 0:
+            self._next = None
+            return 0
+        if self._next is None:
+            self._next = now
+        delay = self._next - now
+        if delay > 0:
+            self._cancel.wait(delay)
+            self.last_overrun = 0
+            self._next += self.period
+            return 0
+        # every frame that starts after its grid point is an overrun
+        overrun = -delay if delay < 0 else 0
+        if overrun > 0:
+            self.overruns += 1
+        if overrun >= self.period:
+            # whole slots were missed, continue with the next grid point that is still ahead instead of catching up
+            self._next += (int(overrun // self.period) + 1) * self.period
+        else:
+            self._next += self.period
+        self.last_overrun = overrun
+        return overrun
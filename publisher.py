@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coalescing, rate-limited hand-over of values to the UI thread.
+
+Acquisition threads may produce values much faster than the UI can repaint. A CoalescingPublisher keeps only the
+latest value and has at most one task in the UI queue at a time, so the queue cannot grow and the labels always show
+the most recent value:
+
+    publisher = CoalescingPublisher(api.queue_task, update_labels, max_rate=10)
+    publisher.publish(thickness, rate, frequency)  # from any thread
+"""
+
+import time
+import threading
+
+
+class CoalescingPublisher(object):
+    """ Calls consumer(*args) with the latest published args in a task queued with queue_task
+
+    max_rate limits the number of consumer calls per second, None disables the limit.
+    """
+    def __init__(self, queue_task, consumer, max_rate=10):
+        self.queue_task = queue_task
+        self.consumer = consumer
+        self.max_rate = max_rate
+        self.published = 0
+        self.delivered = 0
+        self._lock = threading.Lock()
+        self._latest = None
+        self._pending = False
+        self._last_delivery = 0
+        self._timer = None
+        self._closed = False
+
+    def publish(self, *args):
+        """ stores args as the latest value and schedules a delivery unless one is pending already """
+        with self._lock:
+            self.published += 1
+            self._latest = args
+            if self._pending or self._closed:
+                return
+            self._pending = True
+            delay = 0
+            if self.max_rate:
+                delay = self._last_delivery + 1 / self.max_rate - time.monotonic()
+            if delay > 0:
+                self._timer = threading.Timer(delay, self._queue)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self._queue()
+
+    def _queue(self):
+        self.queue_task(self._deliver)
+
+    def _deliver(self):
+        with self._lock:
+            args = self._latest
+            self._pending = False
+            self._timer = None
+            self._last_delivery = time.monotonic()
+            if self._closed:
+                return
+            self.delivered += 1
+        self.consumer(*args)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
@@ -1,101 +1,743 @@
 #!/usr/bin/python
 
 import sys
+import enum
 import time
 import serial
 import argparse
+import threading
+import collections
 import numpy as np
 
+try:
+    from . import metrics
+    from . import pacing
+    from . import recorder
+except ImportError:
+    # run as a script (python quartz.py ...) on a machine without Swift
+    import metrics
+    import pacing
+    import recorder
 
-class QPOD:
-    """ Class for managing the QPOD controller"""
+AT_CONST = 16.68e12
+DENS_QUARZ = 2.648
+PI = 3.1416
+FREQ_INIT = 6e6
+GATEPERIOD = '2500000'
+MEASUREMENTPERIOD = '25000000'
+# clock of the controller, gate and measurement period are given in its ticks
+CLOCK_HZ = 100e6
+
+
+class QPODError(IOError):
+    """ Raised when the communication with QPOD fails """
+
+
+class QPODTimeoutError(QPODError):
+    """ Raised when QPOD does not answer within the command deadline """
+
+
+class QPODResponseError(QPODError):
+    """ Raised when QPOD sends an answer that cannot be parsed """
+
+
+class QPODSettlingError(QPODError):
+    """ Raised when a reading is requested before a changed gate period is in effect """
+
+
+class QPODStatus(enum.Enum):
+    ok = 'ok'
+    timeout = 'timeout'
+    reconnecting = 'reconnecting'
+
+
+def format_command(command):
+    """ returns the encoded frame for a QPOD command """
+    return ('!' + command + '\r\n').encode('ASCII')
+
+
+def parse_counts(answer):
+    """ extracts the raw gate count from an answer to 'A1' """
+    return float(answer[2:])
+
+
+def counts_to_frequency(counts, gateperiod, out=None):
+    """ converts raw gate counts into crystal frequencies (vectorized) """
+    return np.divide(200.0*float(gateperiod), counts, out=out)
+
+
+def frequency_to_thickness(freq, density=1, z_ratio=1, out=None):
+    """ converts crystal frequencies into thickness (vectorized)
+
+    All intermediate results are computed in out, so passing a preallocated float64 array avoids any allocation.
+    """
+    freq = np.asarray(freq, dtype=np.float64)
+    if out is None:
+        out = np.empty_like(freq)
+    # Correct for z-ratio
+    np.subtract(FREQ_INIT, freq, out=out)
+    np.multiply(out, PI/FREQ_INIT, out=out)
+    np.tan(out, out=out)
+    np.multiply(out, z_ratio, out=out)
+    np.arctan(out, out=out)
+    # Calculate thickness
+    np.divide(out, freq, out=out)
+    np.multiply(out, (AT_CONST*DENS_QUARZ)/(PI*density*z_ratio), out=out)
+    return out
+
+
+def convert_counts(counts, gateperiod, density=1, z_ratio=1, thickness_out=None, frequency_out=None):
+    """ converts raw gate counts into (thickness, frequency) arrays in one vectorized pass """
+    counts = np.asarray(counts, dtype=np.float64)
+    if frequency_out is None:
+        frequency_out = np.empty_like(counts)
+    counts_to_frequency(counts, gateperiod, out=frequency_out)
+    thickness = frequency_to_thickness(frequency_out, density, z_ratio, out=thickness_out)
+    return thickness, frequency_out
+
+
+class SampleQueue(object):
+    """ Thread-safe buffer of (timestamp, raw count, frequency) samples """
+    def __init__(self, maxlen=100000):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def put(self, sample):
+        with self._lock:
+            self._samples.append(sample)
+
+    def extend(self, samples):
+        with self._lock:
+            self._samples.extend(samples)
+
+    def latest(self):
+        """ returns the most recent sample without removing it (None if empty) """
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def drain(self):
+        """ removes and returns all queued samples, never blocks on the serial port """
+        with self._lock:
+            samples = list(self._samples)
+            self._samples.clear()
+        return samples
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+class QPODBase(object):
+    """ Settings and conversions shared by the blocking and the asyncio QPOD clients """
     def __init__(self):
-        """ initializes nothing """
-        self.AT_CONST=16.68e12
-        self.DENS_QUARZ=2.648
-        self.PI=3.1416
-        self.FREQ_INIT = 6e6
+        self.AT_CONST = AT_CONST
+        self.DENS_QUARZ = DENS_QUARZ
+        self.PI = PI
+        self.FREQ_INIT = FREQ_INIT
         self.density = 1
         self.z_ratio = 1
+        self.gateperiod = GATEPERIOD
+        self.measurementperiod = MEASUREMENTPERIOD
+        # time base of the sample timestamps, replay.ReplayQPOD replaces it with the recorded time
+        self.clock = time.time
+
+    def setup_commands(self):
+        """ returns the commands that configure gate and measurement period """
+        return ['B' + self.gateperiod, 'C' + self.measurementperiod]
+
+    @property
+    def gate_time(self):
+        """ gate time in s """
+        return int(self.gateperiod) / CLOCK_HZ
+
+    @property
+    def measurement_time(self):
+        """ time between two measurements in s """
+        return int(self.measurementperiod) / CLOCK_HZ
+
+    @property
+    def sample_rate(self):
+        """ number of independent measurements per s, reading faster only repeats them """
+        return 1 / self.measurement_time
+
+    @property
+    def settling(self):
+        """ True while a changed gate period is not yet in effect """
+        return False
+
+    @property
+    def frequency_resolution(self):
+        """ frequency resolution in Hz, one cycle within the gate time """
+        return 1 / self.gate_time
+
+    def thickness_resolution(self, freq):
+        """ thickness resolution in A at the crystal frequency freq """
+        half = self.frequency_resolution / 2
+        return abs(self.thickness(freq - half) - self.thickness(freq + half))
+
+    @staticmethod
+    def check_periods(gateperiod, measurementperiod):
+        """ returns gate and measurement period as the strings sent to QPOD, raises a ValueError if they are invalid """
+        gateperiod = int(gateperiod)
+        measurementperiod = int(measurementperiod)
+        if gateperiod <= 0 or measurementperiod < gateperiod:
+            raise ValueError('The gate period must be positive and not longer than the measurement period, got {:d} '
+                             'and {:d}.'.format(gateperiod, measurementperiod))
+        return str(gateperiod), str(measurementperiod)
+
+    def frequency(self, counts):
+        """ converts a raw gate count into the crystal frequency """
+        return float(counts_to_frequency(counts, self.gateperiod))
+
+    def thickness(self, freq):
+        """ converts a crystal frequency into thickness """
+        return float(frequency_to_thickness(freq, self.density, self.z_ratio))
+
+    def convert(self, counts=None, frequencies=None, thickness_out=None, frequency_out=None):
+        """ converts arrays of raw counts or frequencies with the current settings
+
+        Returns (thickness, frequency) arrays. Pass either counts or frequencies.
+        """
+        if counts is not None:
+            return convert_counts(counts, self.gateperiod, self.density, self.z_ratio, thickness_out=thickness_out,
+                                  frequency_out=frequency_out)
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        return frequency_to_thickness(frequencies, self.density, self.z_ratio, out=thickness_out), frequencies
+
+
+class QPOD(QPODBase):
+    """ Class for managing the QPOD controller"""
+    def __init__(self):
+        """ initializes nothing """
+        super().__init__()
+        self.samples = SampleQueue()
+        # not reentrant on purpose: stream() may be finalized from a different thread than the one that started it
+        self._serial_lock = threading.Lock()
+        self._poll_thread = None
+        self._poll_stop = threading.Event()
+        self._poll_scheduler = pacing.FrameScheduler(0)
+        # set by multi.QPODManager, which then polls this controller from its worker pool
+        self.poller = None
+        # called with every (timestamp, raw count, frequency) sample right after it was read
+        self.on_sample = None
+        # deadline for every command in s
+        self.timeout = 1.0
+        # consecutive failed commands after which the watchdog reconnects
+        self.max_failures = 3
+        self.reconnect_delay = 0.5
+        self.max_reconnect_delay = 30
+        self.status = QPODStatus.ok
+        self.failures = 0
+        self.serialport = None
+        self._reconnect_thread = None
+        self._reconnect_stop = threading.Event()
+        # time.monotonic() until which QPOD may still report measurements with the previous gate
+        self._settle_until = 0
         #print("QPOD initialized")
-        # self.ser=0
+        self.ser = None
+        self._rx = b''
 
 
     def openconnection(self, serialport='/dev/ttyUSB0'):
         """ open serial connection to QPOD controller """
+        self.serialport = serialport
+        if self.ser is not None:
+            self.ser.close()
         # connect to serial interface
         # configure the serial connections (the parameters differs on the device you
         # are connecting to)
         # global ser
+        # serial_for_url also accepts pyserial URLs such as loop:// or socket://, plain device paths
+        # (including the pty of simulator.QPODSimulator) are opened like with serial.Serial
         try:
-            self.ser = serial.Serial(
-                port=serialport,
+            self.ser = serial.serial_for_url(
+                serialport,
                 baudrate=115200,
                 parity=serial.PARITY_NONE,
                 stopbits=serial.STOPBITS_ONE,
-                bytesize=serial.EIGHTBITS
+                bytesize=serial.EIGHTBITS,
+                timeout=self.timeout,
+                write_timeout=self.timeout
             )
-            self.gateperiod='2500000'
-            self.measurementperiod='25000000'
-            self.comm('B' + self.gateperiod)
-            self.comm('C' + self.measurementperiod)
+            # discard answers that are still in flight from a previous session
+            self._reset_input()
+            self.comm_many(self.setup_commands())
             #print("Connection fine.")
         except Exception as e:
             print("Could not connect to serial device. Reason: {}".format(str(e)))
+            return False
+        return True
+
+    @property
+    def connected(self):
+        return self.ser is not None and self.ser.is_open
 
 
     def closeconnection(self):
         """ close serial connection to QPOD """
-        self.ser.close()
+        self.stop_polling()
+        self._reconnect_stop.set()
+        if self._reconnect_thread is not None and self._reconnect_thread is not threading.current_thread():
+            self._reconnect_thread.join(self.timeout + 1)
+        if self.ser is not None:
+            self.ser.close()
         #print('Serial Connection closed.')
 
 
+    def _failure(self, exception):
+        # counts a failed command and starts the reconnect watchdog after max_failures in a row
+        metrics.DROPPED_RESPONSES.add()
+        if threading.current_thread() is not self._reconnect_thread:
+            self.failures += 1
+            if self.status is not QPODStatus.reconnecting:
+                self.status = QPODStatus.timeout
+                if self.failures >= self.max_failures and self.serialport is not None:
+                    self._start_reconnect()
+        return exception
+
+    def _success(self):
+        self.failures = 0
+        if self.status is QPODStatus.timeout:
+            self.status = QPODStatus.ok
+
+    def _check_available(self):
+        if self.status is QPODStatus.reconnecting and threading.current_thread() is not self._reconnect_thread:
+            raise QPODError('Reconnecting to QPOD.')
+        if self.ser is None:
+            raise QPODError('Not connected to QPOD.')
+
+    @property
+    def settling(self):
+        return time.monotonic() < self._settle_until
+
+    def _check_settled(self):
+        if self.settling:
+            raise QPODSettlingError('Waiting for the new gate period to take effect.')
+
+    def _reset_input(self):
+        self.ser.reset_input_buffer()
+        self._rx = b''
+
+    def _readline(self):
+        # serial.readline reads byte by byte, this takes everything that has arrived with one read call
+        while b'\n' not in self._rx:
+            data = self.ser.read(max(self.ser.in_waiting, 1))
+            if not data:
+                # the deadline passed, return the incomplete answer like serial.readline
+                answer, self._rx = self._rx, b''
+                return answer
+            self._rx += data
+        answer, self._rx = self._rx.split(b'\n', 1)
+        return answer + b'\n'
+
+    def _check_answer(self, answer):
+        # readline returns without a line ending when the deadline passed, a late answer would then be taken as the
+        # answer to the next command, so the input is discarded
+        if not answer.endswith(b'\n'):
+            self._reset_input()
+            raise self._failure(QPODTimeoutError('No answer from QPOD within {:g} s.'.format(self.timeout)))
+
+    def _transfer(self, data, n):
+        # writes data and reads n answers, must be called with the serial lock held
+        start = metrics.clock()
+        try:
+            if self.failures:
+                # a late answer to a command that timed out may still have arrived
+                self._reset_input()
+            self.ser.write(data)
+            #time.sleep(0.1)
+            answers = [self._readline() for i in range(n)]
+        except (serial.SerialException, OSError) as e:
+            raise self._failure(QPODError('Serial communication with QPOD failed. Reason: {}'.format(str(e))))
+        metrics.SERIAL.observe_since(start)
+        metrics.BYTES_WRITTEN.add(len(data))
+        metrics.BYTES_READ.add(sum(len(answer) for answer in answers))
+        for answer in answers:
+            self._check_answer(answer)
+        return answers
+
     def comm(self, command='A1'):
         """ reads answer from QPOD """
-        sendstring = '!' + command +'\r\n'
-        self.ser.write(sendstring.encode('ASCII'))
-        #time.sleep(0.1)
-        answer = self.ser.readline()
+        self._check_available()
+        with self._serial_lock:
+            answer = self._transfer(format_command(command), 1)[0]
         #while self.ser.inWaiting() > 0:
         #    answer += self.ser.read(1).decode()
         return answer
 
+    def comm_many(self, commands):
+        """ sends several commands in one write and returns their answers in order """
+        self._check_available()
+        with self._serial_lock:
+            answers = self._transfer(b''.join(format_command(command) for command in commands), len(commands))
+        self._success()
+        return answers
+
+    def stream(self, command='A1', count=None, depth=8):
+        """ yields the answers to command repeated count times (forever if count is None)
+
+        Up to depth requests are kept in flight and they are refilled in bursts once half of them have been answered,
+        so a long series of readings costs about one round-trip. The serial port is reserved for the stream until it
+        is exhausted or closed.
+        """
+        frame = format_command(command)
+        self._check_available()
+        with self._serial_lock:
+            sent = 0
+            received = 0
+            error = False
+            if self.failures:
+                self._reset_input()
+            try:
+                while count is None or received < count:
+                    in_flight = sent - received
+                    try:
+                        if in_flight <= depth // 2:
+                            n = depth - in_flight
+                            if count is not None:
+                                n = min(n, count - sent)
+                            if n > 0:
+                                self.ser.write(frame * n)
+                                metrics.BYTES_WRITTEN.add(len(frame) * n)
+                                sent += n
+                        # in a pipelined stream this is the time spent waiting for each answer
+                        start = metrics.clock()
+                        answer = self._readline()
+                        metrics.SERIAL.observe_since(start)
+                        metrics.BYTES_READ.add(len(answer))
+                    except (serial.SerialException, OSError) as e:
+                        error = True
+                        raise self._failure(QPODError('Serial communication with QPOD failed. Reason: {}'.format(
+                            str(e))))
+                    try:
+                        self._check_answer(answer)
+                    except QPODError:
+                        error = True
+                        raise
+                    received += 1
+                    yield answer
+            finally:
+                # consume answers that are still in flight so that the next command gets its own answer
+                if not error:
+                    for i in range(sent - received):
+                        self._readline()
+
+    def set_periods(self, gateperiod=None, measurementperiod=None, wait=False):
+        """ changes gate and/or measurement period (in ticks of CLOCK_HZ) while connected
+
+        A longer gate gives a finer frequency resolution at a lower sample rate. QPOD may still report a measurement
+        taken with the old gate for up to one measurement period, so readings raise a QPODSettlingError until the first
+        measurement with the new settings is complete. With wait=True this returns only then.
+        """
+        gateperiod, measurementperiod = self.check_periods(gateperiod or self.gateperiod,
+                                                           measurementperiod or self.measurementperiod)
+        if (gateperiod, measurementperiod) == (self.gateperiod, self.measurementperiod):
+            return
+        self._check_available()
+        settle_time = self.measurement_time + int(measurementperiod) / CLOCK_HZ
+        with self._serial_lock:
+            self._transfer(b''.join(format_command(command) for command in
+                                    ('B' + gateperiod, 'C' + measurementperiod)), 2)
+            self._success()
+            # the port is not held while the gate settles, readings are refused instead of converted with the wrong
+            # gate
+            self._settle_until = time.monotonic() + settle_time
+            self.gateperiod = gateperiod
+            self.measurementperiod = measurementperiod
+        if wait:
+            time.sleep(settle_time)
+
+    def _parse_counts(self, answer):
+        # a reading only counts as a success once its answer could be parsed, otherwise a controller that keeps
+        # sending garbage would reset the failures before the watchdog sees them
+        try:
+            counts = parse_counts(answer)
+        except ValueError:
+            raise self._failure(QPODResponseError('Garbled answer from QPOD: {!r}'.format(answer)))
+        self._success()
+        return counts
+
+    def readcounts(self):
+        """ reads the raw gate count from QPOD """
+        self._check_settled()
+        return self._parse_counts(self.comm('A1'))
+
+    def readsamples(self, n, depth=8):
+        """ reads n samples in a pipelined burst and returns (timestamps, counts, frequencies) arrays """
+        timestamps = np.empty(n, dtype=np.float64)
+        counts = np.empty(n, dtype=np.float64)
+        on_sample = self.on_sample
+        self._check_settled()
+        for i, answer in enumerate(self.stream('A1', n, depth)):
+            timestamps[i] = self.clock()
+            counts[i] = self._parse_counts(answer)
+            if callable(on_sample):
+                on_sample((timestamps[i], counts[i], self.frequency(counts[i])))
+        metrics.SAMPLES.add(n)
+        return timestamps, counts, counts_to_frequency(counts, self.gateperiod)
+
+    def readmeasurements(self, n, interval=None):
+        """ reads n samples one every interval s (default the measurement period) and returns (timestamps, counts,
+        frequencies) arrays
+
+        QPOD reports the same measurement until the measurement period has passed, so unlike readsamples every sample
+        is a new measurement. This takes n times the interval.
+        """
+        scheduler = pacing.FrameScheduler(self.measurement_time if interval is None else interval)
+        timestamps = np.empty(n, dtype=np.float64)
+        counts = np.empty(n, dtype=np.float64)
+        for i in range(n):
+            scheduler.wait()
+            timestamps[i], counts[i], frequency = self.readsample()
+        return timestamps, counts, counts_to_frequency(counts, self.gateperiod)
+
+    def readsample(self):
+        """ returns a (timestamp, raw count, frequency) tuple """
+        counts = self.readcounts()
+        sample = (self.clock(), counts, self.frequency(counts))
+        metrics.SAMPLES.add()
+        if callable(self.on_sample):
+            self.on_sample(sample)
+        return sample
+
     def readthickness(self, return_freq=False):
 
-        response=self.comm('A1')[2:]
-        freq=200.0*float(self.gateperiod)/float(response)
-        # Calculate thickness
-        thickness=(self.AT_CONST*self.DENS_QUARZ)/(self.PI*freq*self.density*self.z_ratio)
-        # Calculate thickness in Angstrom
-        #thickness *= 1e-6
-        # Correct for z-ratio
-        thickness *= np.arctan(self.z_ratio * np.tan(self.PI*(self.FREQ_INIT - freq)/self.FREQ_INIT))
+        freq=self.frequency(self.readcounts())
+        thickness=self.thickness(freq)
         if return_freq:
             return (thickness, freq)
         else:
             return thickness    
 
-def main():
-    # cli parser config
-#    parser = argparse.ArgumentParser(description='Handle QPOD')
-#    switch = parser.add_mutually_exclusive_group(required=True)
-#    switch.add_argument('--read', help='read thickness',
-#                        required=False)
+    def _start_reconnect(self):
+        if self._reconnect_thread is not None and self._reconnect_thread.is_alive():
+            return
+        self.status = QPODStatus.reconnecting
+        self._reconnect_stop.clear()
+        self._reconnect_thread = threading.Thread(target=self._reconnect_loop, name='QPOD reconnect', daemon=True)
+        self._reconnect_thread.start()
+
+    def _reconnect_loop(self):
+        # reopens the port with exponential backoff, openconnection sends the gate and measurement period again
+        delay = self.reconnect_delay
+        while not self._reconnect_stop.is_set():
+            with self._serial_lock:
+                try:
+                    self.ser.close()
+                except Exception:
+                    pass
+            if self.openconnection(self.serialport):
+                try:
+                    self.readcounts()
+                except QPODError as e:
+                    print("QPOD does not answer after reconnecting. Reason: {}".format(str(e)))
+                else:
+                    self.failures = 0
+                    self.status = QPODStatus.ok
+                    return
+            self._reconnect_stop.wait(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    @property
+    def polling(self):
+        if self.poller is not None:
+            return self.poller.polling and self in self.poller.polled
+        return self._poll_thread is not None and self._poll_thread.is_alive()
 
+    def start_polling(self, interval=None, burst=1):
+        """ starts a worker thread that samples QPOD continuously and fills self.samples
+
+        By default the readings are paced with the measurement period (following set_periods), so every reading is a
+        new measurement. interval sets a fixed pace in s instead, with interval=0 readings are issued back-to-back and
+        the sampling rate is set by the controller's response time, which mostly repeats the same measurement.
+        With burst > 1 each poll reads that many samples through the pipelined transport.
+        """
+        if self.poller is not None:
+            self.poller.start_polling(interval, [self])
+            return
+        if self.polling:
+            return
+        self._poll_stop.clear()
+        self._poll_scheduler = pacing.FrameScheduler(0)
+        self._poll_thread = threading.Thread(target=self._poll_loop, args=(interval, burst), name='QPOD polling',
+                                             daemon=True)
+        self._poll_thread.start()
+
+    def stop_polling(self, timeout=5):
+        if self.poller is not None:
+            self.poller.stop_polling(timeout, [self])
+            return
+        self._poll_stop.set()
+        self._poll_scheduler.cancel()
+        if self._poll_thread is not None:
+            self._poll_thread.join(timeout)
+        self._poll_thread = None
+
+    def _poll_loop(self, interval, burst):
+        scheduler = self._poll_scheduler
+        while not self._poll_stop.is_set():
+            scheduler.set_period(self.measurement_time if interval is None else interval)
+            scheduler.wait()
+            if self._poll_stop.is_set():
+                break
+            try:
+                if burst > 1:
+                    self.samples.extend(zip(*self.readsamples(burst)))
+                else:
+                    self.samples.put(self.readsample())
+            except QPODSettlingError:
+                continue
+            except Exception as e:
+                print("Polling QPOD failed. Reason: {}".format(str(e)))
+                self._poll_stop.wait(1)
+
+def _acquire_chunks(qp, rate=0, duration=None, chunk=256, depth=8):
+    """ yields (timestamps, counts, frequencies) arrays until duration s have passed (forever if None)
+
+    With rate=0 QPOD is read back-to-back in pipelined bursts of chunk samples, otherwise one sample is read every
+    1/rate s on a fixed grid and the samples are yielded at least twice per second.
+    """
+    endtime = None if duration is None else time.time() + duration
+    scheduler = pacing.FrameScheduler(1 / rate if rate > 0 else 0)
+    samples = []
+    last_yield = time.time()
+    while endtime is None or time.time() < endtime:
+        try:
+            if rate <= 0:
+                yield qp.readsamples(chunk, depth)
+                continue
+            scheduler.wait()
+            samples.append(qp.readsample())
+        except QPODError as e:
+            print("Reading QPOD failed. Reason: {}".format(str(e)), file=sys.stderr)
+            time.sleep(qp.timeout)
+            continue
+        if len(samples) >= chunk or time.time() - last_yield >= 0.5:
+            yield tuple(np.array(column, dtype=np.float64) for column in zip(*samples))
+            samples = []
+            last_yield = time.time()
+    if samples:
+        yield tuple(np.array(column, dtype=np.float64) for column in zip(*samples))
 
 
-#    args = parser.parse_args()
-    # print args.on, args.offA
+def _read(qp, args):
+    for i in range(args.count):
+        thickness, freq = qp.readthickness(return_freq=True)
+        print('{:.3f}\t{:.3f}'.format(thickness, freq))
+
+
+def _stream(qp, args):
+    for timestamps, counts, frequencies in _acquire_chunks(qp, args.rate, args.duration, args.chunk, args.depth):
+        thickness, frequencies = qp.convert(frequencies=frequencies)
+        np.savetxt(sys.stdout, np.column_stack((timestamps, thickness, frequencies)), fmt=('%.6f', '%.4f', '%.3f'),
+                   delimiter='\t')
+        sys.stdout.flush()
+
+
+def _record(qp, args):
+    fmt = args.format or ('csv' if args.path.endswith('.csv') else 'binary')
+    n = 0
+    if fmt == 'binary':
+        log = recorder.LogRecorder(args.path)
+        try:
+            for timestamps, counts, frequencies in _acquire_chunks(qp, args.rate, args.duration, args.chunk,
+                                                                   args.depth):
+                thickness, frequencies = qp.convert(frequencies=frequencies)
+                log.extend(timestamps, counts, frequencies, thickness, qp.density, qp.z_ratio)
+                n += len(timestamps)
+        finally:
+            log.close()
+    else:
+        # the file object buffers the rows, they are written in blocks of about a megabyte. The counts are fractional
+        # and written with full precision, ReplayQPOD.from_csv plays them back
+        with open(args.path, 'a', buffering=2**20) as f:
+            if f.tell() == 0:
+                f.write('timestamp,counts,frequency,thickness,density,z_ratio\n')
+            for timestamps, counts, frequencies in _acquire_chunks(qp, args.rate, args.duration, args.chunk,
+                                                                   args.depth):
+                thickness, frequencies = qp.convert(frequencies=frequencies)
+                parameters = np.broadcast_to((qp.density, qp.z_ratio), (len(timestamps), 2))
+                np.savetxt(f, np.column_stack((timestamps, counts, frequencies, thickness, parameters)),
+                           fmt=('%.6f', '%.17g', '%.9g', '%.4f', '%g', '%g'), delimiter=',')
+                n += len(timestamps)
+    print('Recorded {:d} samples to {}.'.format(n, args.path), file=sys.stderr)
+
+
+def _bench(qp, args):
+    # round trip of single commands
+    latencies = np.empty(args.count, dtype=np.float64)
+    for i in range(args.count):
+        start = time.perf_counter()
+        qp.readcounts()
+        latencies[i] = time.perf_counter() - start
+    percentiles = np.percentile(latencies, [50, 90, 99, 100]) * 1e3
+    print('Round trip: {:.3f} ms median, {:.3f} ms p90, {:.3f} ms p99, {:.3f} ms max ({:d} commands)'.format(
+        *percentiles, args.count))
+    # throughput of pipelined bursts
+    n = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.duration:
+        timestamps, counts, frequencies = qp.readsamples(args.chunk, args.depth)
+        qp.convert(frequencies=frequencies)
+        n += len(timestamps)
+    elapsed = time.perf_counter() - start
+    print('Pipelined (depth {:d}): {:.0f} samples/s, {:.1f} us CPU per sample'.format(
+        args.depth, n / elapsed, (time.process_time() - cpu_start) / n * 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read, stream, record and benchmark a QPOD controller')
+    parser.add_argument('--port', default='/dev/ttyUSB0', help='serial port or pyserial URL')
+    parser.add_argument('--density', type=float, default=1.0, help='film density in g/cm3')
+    parser.add_argument('--z-ratio', type=float, default=1.0, help='acoustic impedance ratio of the film')
+    parser.add_argument('--depth', type=int, default=8, help='number of pipelined requests in bursts')
+    parser.add_argument('--chunk', type=int, default=256, help='number of samples per burst')
+    parser.add_argument('--gate-ms', type=float, default=None, help='gate time in ms')
+    parser.add_argument('--period-ms', type=float, default=None, help='measurement period in ms')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    read_parser = subparsers.add_parser('read', help='print thickness and frequency')
+    read_parser.add_argument('--count', type=int, default=1, help='number of readings')
+    for name, help in (('stream', 'print timestamp, thickness and frequency of every reading'),
+                       ('record', 'write every reading to a binary log (see recorder.read_log) or a CSV file')):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument('--rate', type=float, default=0, help='readings per s, 0 reads as fast as possible')
+        subparser.add_argument('--duration', type=float, default=None, help='stop after this many s')
+    record_parser = subparsers.choices['record']
+    record_parser.add_argument('path', help='output file, appended to if it exists')
+    record_parser.add_argument('--format', choices=('binary', 'csv'), default=None,
+                               help='file format (default: csv for *.csv, otherwise binary)')
+    bench_parser = subparsers.add_parser('bench', help='measure round trip latency and pipelined sample rate')
+    bench_parser.add_argument('--count', type=int, default=200, help='number of single commands timed')
+    bench_parser.add_argument('--duration', type=float, default=5, help='duration of the throughput test in s')
+    args = parser.parse_args(argv)
+
     qp=QPOD()
-    qp.openconnection()
-#    if args.read:
-        #print("Starting READ-Procedure")
-        #qp.readthickness()
-    print(qp.readthickness())
-    qp.closeconnection()
+    qp.density = args.density
+    qp.z_ratio = args.z_ratio
+    if not qp.openconnection(args.port):
+        return 1
+    commands = {'read': _read, 'stream': _stream, 'record': _record, 'bench': _bench}
+    try:
+        if args.gate_ms or args.period_ms:
+            qp.set_periods(args.gate_ms and int(round(args.gate_ms * 1e-3 * CLOCK_HZ)),
+                           args.period_ms and int(round(args.period_ms * 1e-3 * CLOCK_HZ)), wait=True)
+        print('Gate {:g} ms, {:.1f} samples/s, {:.3g} Hz resolution'.format(qp.gate_time * 1e3, qp.sample_rate,
+                                                                          qp.frequency_resolution), file=sys.stderr)
+        commands[args.command](qp, args)
+    except KeyboardInterrupt:
+        pass
+    except (QPODError, ValueError) as e:
+        print("QPOD command failed. Reason: {}".format(str(e)), file=sys.stderr)
+        return 1
+    finally:
+        qp.closeconnection()
+    return 0
 
 
 
 if __name__ == "__main__":
-    main()
-
+    sys.exit(main())
@@ -6,38 +6,129 @@ Created on Tue Apr 11 09:39:15 2017
 @author: microscope
 """
 
-from . import quartz
+try:
+    from . import quartz
+    from . import metrics
+    from . import history
+    from . import recorder
+    from . import rates
+    from . import decimation
+    from . import triggers
+    from . import publisher
+    from . import pacing
+    from . import sharedfeed
+except ImportError:
+    # imported as a plain module like 'python quartz.py' does
+    import quartz
+    import metrics
+    import history
+    import recorder
+    import rates
+    import decimation
+    import triggers
+    import publisher
+    import pacing
+    import sharedfeed
+import math
 import time
+import threading
 import numpy as np
 
 class Camera(object):
-    def __init__(self):
-        self.quartz = quartz.QPOD()
-        self.quartz.openconnection()
+    def __init__(self, history_capacity=2**20, poll_interval=None, serialport='/dev/ttyUSB0', qpod=None,
+                 connect_timeout=10):
+        # creating a camera is cheap, the connection is made in the background on the first start_live (or connect)
+        if qpod is None:
+            qpod = quartz.QPOD()
+        self.quartz = qpod
+        self.serialport = serialport
+        self.connect_timeout = connect_timeout
+        # after a failed attempt a new one is started at most every connect_retry_interval s
+        self.connect_retry_interval = 5
+        self._connect_started = -np.inf
+        # 'disconnected', 'connecting', 'connected' or 'failed'
+        self.connection_state = 'disconnected'
+        self.on_connection_state_changed = None
+        self._connected = threading.Event()
+        self._connect_thread = None
+        self._live = False
+        self._lock = threading.Lock()
         self.time_to_show = 300 #s
-        self.values = []
-        self.timestamps = []
+        self.history = history.ThicknessHistory(history_capacity)
+        # None reads one sample per frame, otherwise a background worker samples QPOD every poll_interval seconds,
+        # 0 samples at the measurement rate of QPOD
+        self.poll_interval = poll_interval
+        # reduce the displayed window to at most display_points samples (None shows every sample)
+        self.display_points = None
+        self.decimation_method = 'minmax'
+        # 'window' sends the whole time_to_show window with every frame, 'sweep' writes only the new samples into a
+        # preallocated buffer of sweep_points that starts over when it is full
+        self.publish_mode = 'window'
+        self.sweep_points = 4096
+        self._sweep_buffer = None
+        self._sweep_pos = 0
+        self._sweep_start_time = 0
+        self._sweep_last_timestamp = -np.inf
+        self._sweep_scale = 1.0
         self.mode = 'Run'
         self.mode_as_index = 0
-        self.exposure_ms = 0
+        # frame period of each mode, exposure_ms is the one of the current mode
+        self.exposures_ms = {'Run': 1000, 'Tune': 200, 'Snap': 1000}
+        self.frame_scheduler = pacing.FrameScheduler()
+        # binning is temporal: every point of the history is the mean of binning raw readings
         self.binning = 1
+        self._bin_carry = (np.empty(0), np.empty(0), np.empty(0))
         self.sensor_dimensions = (512,512)
         self.readout_area = self.sensor_dimensions
-        self.binning_values = [1]
+        self.binning_values = [1, 2, 4, 8, 16, 32, 64, 128]
         self.frame_number = 0
-        self.starttime = time.time()
-        self.thickness = self.quartz.readthickness()
+        self.starttime = self.quartz.clock()
+        self.thickness = 0
+        self.frequency = 0
         self.rate = 0
-        self.zero_thickness = self.thickness
+        self.rate_estimator = rates.LeastSquaresRate()
+        self.zero_thickness = 0
+        # frequency at zeroing, zero_thickness follows it when density or z-ratio change
+        self.zero_frequency = None
+        # (history.written, zero_frequency) of every zeroing, so each sample is recomputed relative to its own zero
+        self._zeros = [(0, None)]
+        # incremented whenever the history is recomputed with new parameters
+        self.parameters_version = 0
         self.update_info_function = None
+        # called without arguments after gate or measurement period changed
+        self.on_periods_changed = None
+        # with adaptive_gate the gate is chosen so that about adaptive_step A are deposited within it, in steps of
+        # powers of two of the lower limit of gate_limits_ms, at most every adaptive_interval s. The measurement period
+        # is adaptive_measurement_ms or the gate if that is longer.
+        self.adaptive_gate = False
+        self.adaptive_step = 0.1
+        self.gate_limits_ms = (5, 1000)
+        self.adaptive_measurement_ms = 250
+        self.adaptive_interval = 5
+        self._last_adaptation = 0
+        self._adapt_thread = None
+        self.recorder = None
+        self.feed = None
+        self.triggers = triggers.TriggerSet()
+        # triggers get their own short-window rate so they react quickly
+        self.trigger_rate_estimator = rates.LeastSquaresRate(window=2.0)
+        self.quartz.on_sample = self._process_triggers
         
+    @property
+    def values(self):
+        return self.history.values
+
+    @property
+    def timestamps(self):
+        return self.history.timestamps
+
     @property
     def density(self):
         return self.quartz.density
     
     @density.setter
     def density(self, density):
-        self.quartz.density = density
+        self.set_parameters(density=density)
         
     @property
     def z_ratio(self):
@@ -45,16 +136,135 @@ class Camera(object):
     
     @z_ratio.setter
     def z_ratio(self, z_ratio):
-        self.quartz.z_ratio = z_ratio
+        self.set_parameters(z_ratio=z_ratio)
+
+    def set_periods_ms(self, gate_ms=None, measurement_ms=None):
+        """ changes gate and/or measurement period of QPOD, until the new gate is in effect the frames show a gap """
+        def ticks(ms):
+            return None if ms is None else int(round(ms * 1e-3 * quartz.CLOCK_HZ))
+        self.quartz.set_periods(ticks(gate_ms), ticks(measurement_ms))
+        if callable(self.on_periods_changed):
+            self.on_periods_changed()
+
+    def timing_info(self):
+        """ returns gate time, sample rate and resolution of the current QPOD settings """
+        qpod = self.quartz
+        return {'gate_time': qpod.gate_time, 'measurement_time': qpod.measurement_time,
+                'sample_rate': qpod.sample_rate, 'frequency_resolution': qpod.frequency_resolution,
+                'thickness_resolution': qpod.thickness_resolution(self.frequency) if self.frequency else None}
+
+    def _adapt_gate(self):
+        now = time.monotonic()
+        if now - self._last_adaptation < self.adaptive_interval:
+            return
+        if self._adapt_thread is not None and self._adapt_thread.is_alive():
+            return
+        # the rate is only meaningful once the estimator has seen a full window of readings
+        settle_time = self.rate_estimator.window or self.adaptive_interval
+        if len(self.history) < 2 or self.quartz.clock() - self.starttime < settle_time:
+            return
+        self._last_adaptation = now
+        low, high = self.gate_limits_ms
+        rate = abs(self.rate)
+        gate_ms = high if rate == 0 else min(max(self.adaptive_step / rate * 1000, low), high)
+        gate_ms = min(low * 2**round(math.log2(gate_ms / low)), high)
+        measurement_ms = max(self.adaptive_measurement_ms, gate_ms)
+        current_ms = (self.quartz.gate_time * 1000, self.quartz.measurement_time * 1000)
+        if all(abs(new - current) < 1e-6 * current for new, current in zip((gate_ms, measurement_ms), current_ms)):
+            return
+        # a failing command may take the timeout, which must not hold up the frames
+        def adapt_thread():
+            try:
+                self.set_periods_ms(gate_ms, measurement_ms)
+            except (quartz.QPODError, ValueError) as e:
+                print("Could not adapt the gate period. Reason: {}".format(str(e)))
+        self._adapt_thread = threading.Thread(target=adapt_thread, name='QPOD adaptive gate', daemon=True)
+        self._adapt_thread.start()
+
+    def set_parameters(self, density=None, z_ratio=None):
+        """ changes density and/or z-ratio and recomputes the whole history from the stored frequencies """
+        with self._lock:
+            old_parameters = (self.quartz.density, self.quartz.z_ratio)
+            if density is not None:
+                self.quartz.density = density
+            if z_ratio is not None:
+                self.quartz.z_ratio = z_ratio
+            if (self.quartz.density, self.quartz.z_ratio) != old_parameters:
+                self.__recompute(*old_parameters)
+
+    def __recompute(self, old_density, old_z_ratio):
+        # one vectorized pass over the history, nothing is done per sample in python
+        density, z_ratio = self.quartz.density, self.quartz.z_ratio
+        if self.zero_frequency is not None:
+            self.zero_thickness = self.quartz.thickness(self.zero_frequency)
+        self.thickness = self.quartz.thickness(self.frequency) if self.frequency else 0
+        frequencies = self.history.frequencies
+        thickness = quartz.frequency_to_thickness(frequencies, density, z_ratio)
+        # the rate estimators restart from the recomputed recent history, they get the absolute thickness
+        for estimator in (self.rate_estimator, self.trigger_rate_estimator):
+            estimator.reset()
+        if len(frequencies):
+            window = self.rate_estimator.window
+            if window:
+                timestamps = self.history.window(window)[0]
+            else:
+                timestamps = self.history.timestamps[-2:]
+            values = thickness[len(thickness)-len(timestamps):]
+            valid = np.isfinite(values)
+            if np.any(valid):
+                self.rate = self.rate_estimator.update_many(timestamps[valid], values[valid])
+        # the spread of binned values is scaled with the local slope of the conversion
+        errors = self.history.errors
+        binned = np.flatnonzero(errors > 0)
+        if len(binned):
+            f = frequencies[binned]
+            delta = 1.0
+            new_slope = quartz.frequency_to_thickness(f + delta, density, z_ratio)
+            new_slope -= quartz.frequency_to_thickness(f - delta, density, z_ratio)
+            old_slope = quartz.frequency_to_thickness(f + delta, old_density, old_z_ratio)
+            old_slope -= quartz.frequency_to_thickness(f - delta, old_density, old_z_ratio)
+            errors[binned] *= np.abs(new_slope / old_slope)
+        # every sample is taken relative to the zero that applied when it was added, zeros that ended before the
+        # oldest sample are dropped
+        first = self.history.written - len(self.history)
+        while len(self._zeros) > 1 and self._zeros[1][0] <= first:
+            del self._zeros[0]
+        ends = [start for start, zero_frequency in self._zeros[1:]] + [self.history.written]
+        for (start, zero_frequency), end in zip(self._zeros, ends):
+            if zero_frequency is not None:
+                thickness[max(start-first, 0):end-first] -= self.quartz.thickness(zero_frequency)
+        self.history.values[:] = thickness
+        carry_timestamps, carry_thickness, carry_frequencies = self._bin_carry
+        self._bin_carry = (carry_timestamps,
+                           quartz.frequency_to_thickness(carry_frequencies, density, z_ratio) - self.zero_thickness,
+                           carry_frequencies)
+        self._sweep_buffer = None
+        self.parameters_version += 1
         
+    @property
+    def exposure_ms(self):
+        return self.exposures_ms.get(self.mode, 1000)
+
+    @exposure_ms.setter
+    def exposure_ms(self, exposure_ms):
+        self.exposures_ms[self.mode] = exposure_ms
+
+    @property
+    def frame_overruns(self):
+        return self.frame_scheduler.overruns
+
     def set_exposure_ms(self, exposure_ms, mode_id):
-        self.exposure_ms = exposure_ms
+        self.exposures_ms[mode_id] = exposure_ms
 
     def get_exposure_ms(self, mode_id):
-        return self.exposure_ms
+        return self.exposures_ms.get(mode_id, 1000)
 
     def set_binning(self, binning, mode_id):
-        self.binning = binning
+        binning = max(int(binning), 1)
+        if binning != self.binning:
+            with self._lock:
+                self.binning = binning
+                self._bin_carry = (np.empty(0), np.empty(0), np.empty(0))
 
     def get_binning(self, mode_id):
         return self.binning
@@ -62,48 +272,364 @@ class Camera(object):
     def get_expected_dimensions(self, binning):
         return self.sensor_dimensions
     
+    def _set_connection_state(self, state):
+        self.connection_state = state
+        if callable(self.on_connection_state_changed):
+            self.on_connection_state_changed(state)
+
+    def connect(self):
+        """ connects to QPOD and takes the first reading in a background thread, returns immediately
+
+        After a failed attempt this does nothing until connect_retry_interval s have passed.
+        """
+        if self._connected.is_set() or (self._connect_thread is not None and self._connect_thread.is_alive()):
+            return
+        if time.monotonic() - self._connect_started < self.connect_retry_interval:
+            return
+        self._connect_started = time.monotonic()
+        self._set_connection_state('connecting')
+        self._connect_thread = threading.Thread(target=self._connect, name='QPOD connect', daemon=True)
+        self._connect_thread.start()
+
+    def _connect(self):
+        try:
+            if not self.quartz.connected and not self.quartz.openconnection(self.serialport):
+                raise IOError('Could not open {}.'.format(self.serialport))
+            self.thickness, self.frequency = self.quartz.readthickness(return_freq=True)
+        except Exception as e:
+            print("Could not connect to QPOD. Reason: {}".format(str(e)))
+            self._set_connection_state('failed')
+            return
+        with self._lock:
+            self.__store_zero()
+        self.starttime = self.quartz.clock()
+        self._connected.set()
+        self._set_connection_state('connected')
+        if self._live:
+            self._start_polling()
+
+    def wait_connected(self, timeout=None):
+        """ blocks until connected, raises an IOError if the connection attempt fails or does not succeed within
+        timeout (default connect_timeout) """
+        self.connect()
+        if self._connect_thread is not None:
+            self._connect_thread.join(self.connect_timeout if timeout is None else timeout)
+        if not self._connected.is_set():
+            if self.connection_state == 'connecting':
+                self._set_connection_state('failed')
+            raise IOError('No connection to QPOD on {}.'.format(self.serialport))
+
+    def _start_polling(self):
+        if self.poll_interval is not None:
+            self.quartz.samples.clear()
+            self.quartz.start_polling(self.poll_interval or None)
+
     def start_live(self):
 #        self.starttime = time.time()
 #        self.values = []
 #        self.timestamps = []
 #        self.set_zero()
-        pass
+        self._live = True
+        self.frame_scheduler.reset()
+        self.connect()
+        if self._connected.is_set():
+            self._start_polling()
     
     def stop_live(self):
-        pass
+        self._live = False
+        self.frame_scheduler.cancel()
+        self.quartz.stop_polling()
         
+    def start_recording(self, path, flush_interval=1.0):
+        """ starts appending every raw reading to the binary log at path (see recorder.read_log) """
+        self.stop_recording()
+        self.recorder = recorder.LogRecorder(path, flush_interval=flush_interval)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def start_feed(self, name='quartzpy', capacity=2**16):
+        """ publishes every raw reading into the shared memory feed name (see sharedfeed.FeedReader) """
+        self.stop_feed()
+        self.feed = sharedfeed.FeedWriter(name, capacity)
+
+    def stop_feed(self):
+        if self.feed is not None:
+            feed = self.feed
+            self.feed = None
+            with self._lock:
+                feed.close()
+
+    def add_threshold_trigger(self, target, callback, lead_time=0, falling=False, once=True):
+        """ calls callback(trigger, timestamp, thickness, rate) when the (zeroed) thickness reaches target
+
+        See triggers.ThicknessTrigger. The callback runs in the thread that reads QPOD and must return quickly.
+        """
+        return self.triggers.add(triggers.ThicknessTrigger(target, callback, lead_time, falling, once))
+
+    def add_rate_trigger(self, low, high, callback, once=False):
+        """ calls callback(trigger, timestamp, thickness, rate) when the rate leaves [low, high] """
+        return self.triggers.add(triggers.RateTrigger(low, high, callback, once))
+
+    def remove_trigger(self, trigger):
+        self.triggers.remove(trigger)
+
+    def _process_triggers(self, sample):
+        if len(self.triggers) == 0:
+            return
+        timestamp, counts, frequency = sample
+        thickness = self.quartz.thickness(frequency)
+        rate = self.trigger_rate_estimator.update(timestamp, thickness)
+        self.triggers.process(timestamp, thickness - self.zero_thickness, rate)
+
+    def set_rate_estimator(self, name, window=None):
+        """ selects one of rates.ESTIMATORS, window is the averaging time in s (None keeps the current one) """
+        if window is None:
+            window = self.rate_estimator.window
+        self.rate_estimator = rates.create_estimator(name, window)
+
+    def _add_samples(self, timestamps, counts, frequencies, thickness=None):
+        with self._lock:
+            return self.__add_samples(timestamps, counts, frequencies, thickness)
+
+    def __add_samples(self, timestamps, counts, frequencies, thickness):
+        start = metrics.clock()
+        thickness, frequencies = self.quartz.convert(frequencies=frequencies, thickness_out=thickness)
+        metrics.CONVERSION.observe_since(start)
+        self.thickness = float(thickness[-1])
+        self.frequency = float(frequencies[-1])
+        # the estimator gets the absolute thickness so that zeroing does not show up as a rate spike
+        self.rate = self.rate_estimator.update_many(timestamps, thickness)
+        if self.recorder is not None:
+            self.recorder.extend(timestamps, counts, frequencies, thickness, self.density, self.z_ratio)
+        thickness -= self.zero_thickness
+        if self.feed is not None:
+            self.feed.publish(timestamps, thickness, frequencies, self.rate, self.density, self.z_ratio)
+        start = metrics.clock()
+        if self.binning > 1:
+            self.__extend_binned(timestamps, thickness, frequencies)
+        else:
+            self.history.extend(timestamps, thickness, frequencies=frequencies)
+        metrics.HISTORY.observe_since(start)
+        return thickness
+
+    def __extend_binned(self, timestamps, thickness, frequencies):
+        # readings that do not fill a complete bin are kept for the next call
+        carry_timestamps, carry_thickness, carry_frequencies = self._bin_carry
+        if len(carry_timestamps):
+            timestamps = np.concatenate((carry_timestamps, timestamps))
+            thickness = np.concatenate((carry_thickness, thickness))
+            frequencies = np.concatenate((carry_frequencies, frequencies))
+        binning = self.binning
+        n_used = len(timestamps) - len(timestamps) % binning
+        self._bin_carry = (timestamps[n_used:].copy(), thickness[n_used:].copy(), frequencies[n_used:].copy())
+        if n_used:
+            bin_timestamps, means, deviations = decimation.bin_mean(timestamps[:n_used], thickness[:n_used], binning)
+            mean_frequencies = frequencies[:n_used].reshape(-1, binning).mean(axis=1)
+            self.history.extend(bin_timestamps, means, deviations, mean_frequencies)
+
+    def _add_gap(self, timestamp):
+        # a NaN sample shows up as a gap in the plot and keeps the time axis running while QPOD does not answer
+        with self._lock:
+            self.history.append(timestamp, np.nan, np.nan)
+
+    def _update_status(self):
+        status = self.quartz.status
+        state = 'connected' if status is quartz.QPODStatus.ok else status.value
+        if self._connected.is_set() and state != self.connection_state:
+            self._set_connection_state(state)
+
+    def _read_samples(self):
+        if self.quartz.polling:
+            samples = self.quartz.samples.drain()
+            if self.binning > 1:
+                # the frame waits until the bin is complete, so every frame shows a new point
+                deadline = time.monotonic() + self.binning * self.quartz.measurement_time + self.quartz.timeout
+                while (len(samples) + len(self._bin_carry[0]) < self.binning and not self.quartz.settling and
+                       self.quartz.status is quartz.QPODStatus.ok and time.monotonic() < deadline):
+                    time.sleep(min(self.quartz.measurement_time, 0.05))
+                    samples += self.quartz.samples.drain()
+            if samples:
+                self._add_samples(*np.array(samples, dtype=np.float64).T)
+                return
+            if self.quartz.status is not quartz.QPODStatus.ok or self.quartz.settling:
+                self._add_gap(self.quartz.clock())
+                return
+            if len(self.history) > 0:
+                return
+        try:
+            if self.binning > 1:
+                # QPOD repeats a measurement until the measurement period has passed, so the readings of one bin are
+                # taken one measurement period apart
+                samples = self.quartz.readmeasurements(self.binning)
+            else:
+                timestamp, counts, frequency = self.quartz.readsample()
+                samples = (np.array([timestamp]), np.array([counts]), np.array([frequency]))
+        except quartz.QPODSettlingError:
+            self._add_gap(self.quartz.clock())
+        except quartz.QPODError as e:
+            print("Reading QPOD failed. Reason: {}".format(str(e)))
+            self._add_gap(self.quartz.clock())
+        else:
+            self._add_samples(*samples)
+
     def acquire_image(self):
+        try:
+            self.wait_connected()
+        except IOError:
+            connected = False
+        else:
+            connected = True
+        # frames start on a grid with the exposure time of the current mode as period, so the frame rate does not
+        # drift with the time spent reading QPOD
+        self.frame_scheduler.set_period(self.exposure_ms / 1000)
+        overrun = self.frame_scheduler.wait()
+        if overrun:
+            metrics.FRAME_OVERRUNS.add()
+        frame_start = metrics.clock()
         data_element = {}
         data_element['properties'] = {}
-        self.thickness, frequency = self.quartz.readthickness(return_freq=True)
-        now = time.time()
-        self.values.append(self.thickness - self.zero_thickness)
-        self.timestamps.append(now)
-        if len(self.values) > 2:
-            self.rate = (self.values[-1] - self.values[-2]) / (self.timestamps[-1] - self.timestamps[-2])
-        
+        if connected:
+            self._read_samples()
+        else:
+            # without QPOD the frames keep coming and show a gap, like while QPOD does not answer
+            self._add_gap(self.quartz.clock())
+        if self.adaptive_gate:
+            self._adapt_gate()
+        self._update_status()
+        frequency = self.frequency
+        # the time base of QPOD, which is the recorded time when replaying
+        now = self.quartz.clock()
         if callable(self.update_info_function):
-            self.update_info_function(self.values[-1], self.rate, frequency)
+            start = metrics.clock()
+            self.update_info_function(self.thickness - self.zero_thickness, self.rate, frequency)
+            metrics.UI_CALLBACK.observe_since(start)
             
-        if self.time_to_show > 0 and self.timestamps[0] < now - self.time_to_show:
-            start_index = np.argmin(np.abs(np.array(self.timestamps) - (now - self.time_to_show)))
-        else:
-            start_index = 0
-        data_element['data'] = np.array(self.values[start_index:], dtype=np.float32)
-        spatial_calibration = [{'offset': self.timestamps[start_index] - self.starttime, 'scale': (now - self.timestamps[start_index]) / len(data_element['data']), 'units': 's'}]
+        start = metrics.clock()
+        with self._lock:
+            if self.publish_mode == 'sweep':
+                sub_area = self.__update_sweep()
+                data_element['data'] = self._sweep_buffer
+                if sub_area is not None:
+                    data_element['state'] = 'partial'
+                    data_element['sub_area'] = sub_area
+                start_time = self._sweep_start_time
+                scale = self._sweep_scale
+            else:
+                timestamps, values = self.history.window(self.time_to_show, now)
+                if self.display_points and len(values) > self.display_points:
+                    timestamps, values = decimation.decimate(timestamps, values, self.display_points,
+                                                             self.decimation_method)
+                if len(values) == 0:
+                    # nothing within time_to_show, e.g. while the first bin fills, is shown as a gap
+                    timestamps, values = np.array([now]), np.array([np.nan])
+                data_element['data'] = np.array(values, dtype=np.float32)
+                start_time = timestamps[0]
+                scale = (now - start_time) / len(data_element['data'])
+            thickness_error = float(self.history.errors[-1]) if len(self.history) else np.nan
+        metrics.HISTORY.observe_since(start)
+        spatial_calibration = [{'offset': start_time - self.starttime, 'scale': scale, 'units': 's'}]
         intenstiy_calibration = {'offset': 0, 'scale': 1, 'units': 'Angstrom'}
         data_element['properties']['spatial_calibrations'] = spatial_calibration
         data_element['properties']['intensity_calibration'] = intenstiy_calibration
         data_element['properties']['frame_number'] = self.frame_number
+        data_element['properties']['qpod_status'] = self.quartz.status.value
+        data_element['properties']['frame_overrun'] = overrun
+        # standard deviation of the raw readings in the latest bin
+        data_element['properties']['thickness_error'] = thickness_error
+        data_element['properties'].update(self.timing_info())
         self.frame_number += 1
-        time.sleep(1)
+        metrics.FRAMES.add()
+        metrics.FRAME.observe_since(frame_start)
         
         return data_element
         
-    def set_zero(self):
+    def __update_sweep(self):
+        # copies the samples added since the last frame into the sweep buffer, so the cost only depends on the number
+        # of new samples. Returns the sub_area ((start,), (length,)) that changed or None if the sweep started over.
+        # The buffer always holds the complete sweep, so it can also be used as a complete frame.
+        if self._sweep_buffer is None or len(self._sweep_buffer) != self.sweep_points:
+            self._sweep_buffer = np.full(self.sweep_points, np.nan, dtype=np.float32)
+            self._sweep_pos = 0
+        buffer = self._sweep_buffer
+        timestamps = self.history.timestamps
+        first_new = int(np.searchsorted(timestamps, self._sweep_last_timestamp, side='right'))
+        new_timestamps = timestamps[first_new:]
+        new_values = self.history.values[first_new:]
+        if len(new_values) == 0:
+            return (self._sweep_pos, ), (0, )
+        self._sweep_last_timestamp = new_timestamps[-1]
+        first_pos = self._sweep_pos
+        if first_pos + len(new_values) > len(buffer):
+            # the samples that do not fit start a new sweep (at most one sweep of them is kept), the ones that would
+            # fill up the old sweep are not shown because the buffer is cleared right away
+            n_rest = min(len(new_values) - (len(buffer) - first_pos), len(buffer))
+            new_timestamps = new_timestamps[-n_rest:]
+            new_values = new_values[-n_rest:]
+            buffer.fill(np.nan)
+            first_pos = 0
+        if first_pos == 0:
+            self._sweep_start_time = new_timestamps[0]
+        n = len(new_values)
+        buffer[first_pos:first_pos+n] = new_values
+        self._sweep_pos = first_pos + n
+        if self._sweep_pos > 1:
+            self._sweep_scale = (new_timestamps[-1] - self._sweep_start_time) / (self._sweep_pos - 1)
+        if first_pos == 0:
+            return None
+        return (first_pos, ), (n, )
+
+    def get_full_resolution_data(self, time_to_show=None, with_errors=False):
+        """ returns copies of (timestamps, values) of the undecimated history within time_to_show (default: all)
+
+        With with_errors=True the standard deviations of the binned readings are returned as a third array.
+        """
+        with self._lock:
+            return tuple(array.copy() for array in self.history.window(time_to_show or 0, with_errors=with_errors))
+
+    def acquire_sequence(self, n, with_timestamps=False):
+        """ reads n samples, one per exposure time of the current mode but at most one per measurement period """
+        self.wait_connected()
+        interval = max(self.exposure_ms / 1000, self.quartz.measurement_time)
+        timestamps, counts, frequencies = self.quartz.readmeasurements(n, interval)
+        thickness = self._add_samples(timestamps, counts, frequencies, np.empty(n, dtype=np.float64))
+        data_element = {}
+        data_element['properties'] = {}
+        scale = (timestamps[-1] - timestamps[0]) / (n - 1) if n > 1 else 0
+        time_calibration = {'offset': timestamps[0] - self.starttime, 'scale': scale, 'units': 's'}
+        intensity_calibration = {'offset': 0, 'scale': 1, 'units': 'Angstrom'}
+        if with_timestamps:
+            data = np.empty((n, 2), dtype=np.float64)
+            np.subtract(timestamps, self.starttime, out=data[:, 0])
+            data[:, 1] = thickness
+            data_element['properties']['spatial_calibrations'] = [time_calibration, {'offset': 0, 'scale': 1, 'units': ''}]
+        else:
+            data = thickness.astype(np.float32)
+            data_element['properties']['spatial_calibrations'] = [time_calibration]
+        data_element['data'] = data
+        data_element['properties']['intensity_calibration'] = intensity_calibration
+        data_element['properties']['frame_number'] = self.frame_number
+        data_element['properties']['frame_count'] = n
+        self.frame_number += 1
+        return data_element
+
+    def __store_zero(self):
+        # must be called with self._lock held
         self.zero_thickness = self.thickness
+        self.zero_frequency = self.frequency
+        self._zeros.append((self.history.written, self.frequency))
+
+    def set_zero(self):
+        with self._lock:
+            self.__store_zero()
+            # a bin must not mix readings from before and after zeroing
+            self._bin_carry = (np.empty(0), np.empty(0), np.empty(0))
         
     def close(self):
+        self.stop_recording()
+        self.stop_feed()
         self.quartz.closeconnection()
         
 class QuartzControllerPanelDelegate(object):
@@ -115,13 +641,18 @@ class QuartzControllerPanelDelegate(object):
         self.panel_positions = ['left', 'right']
         self.panel_position = 'right'
         self.quartzcam = None
+        # maximum number of info label updates per second
+        self.info_refresh_rate = 10
+        self.publishers = []
         
     @property
     def quartzcam_data_item(self):
         return self.__api.get_data_item_for_hardware_source('quartzcam')
 
     def close(self):
-        pass
+        for info_publisher in self.publishers:
+            info_publisher.close()
+        self.publishers = []
 
     def create_panel_widget(self, ui, document_controller):
         self.quartzcam = self.__api.get_hardware_source_by_id('quartzcam', '1')._hardware_source._CameraHardwareSource__camera_adapter.camera
@@ -161,14 +692,72 @@ class QuartzControllerPanelDelegate(object):
                     self.quartzcam.time_to_show = time_to_show
             
             time_field.text = '{:.0f}'.format(self.quartzcam.time_to_show)
+
+        def rate_estimator_changed(name):
+            self.quartzcam.set_rate_estimator(name)
+
+        def rate_window_finished(text):
+            if len(text) > 0:
+                try:
+                    window = float(text)
+                except ValueError:
+                    pass
+                else:
+                    self.quartzcam.set_rate_estimator(self.quartzcam.rate_estimator.name, window)
+
+            rate_window_field.text = '{:.1f}'.format(self.quartzcam.rate_estimator.window or 0)
             
         def update_info_labels(thickness, rate, frequency):
-            def update_labels():
-                thickness_label.text = '{:.2f}'.format(thickness)
-                rate_label.text = '{:.1f}'.format(rate)
-                frequency_label.text = '{:.1f}'.format(frequency*1e6)
-                
-            self.__api.queue_task(update_labels)
+            thickness_label.text = '{:.2f}'.format(thickness)
+            rate_label.text = '{:.1f}'.format(rate)
+            frequency_label.text = '{:.1f}'.format(frequency*1e6)
+
+        def update_status_label(state):
+            status_label.text = state
+
+        def set_periods(gate_ms=None, measurement_ms=None):
+            # QPOD is reserved until the new gate is in effect, which must not block the UI
+            def set_periods_thread():
+                try:
+                    self.quartzcam.set_periods_ms(gate_ms, measurement_ms)
+                except (quartz.QPODError, ValueError) as e:
+                    print("Could not set the gate period. Reason: {}".format(str(e)))
+                    timing_publisher.publish()
+            threading.Thread(target=set_periods_thread, daemon=True).start()
+
+        def gate_finished(text):
+            if len(text) > 0:
+                try:
+                    set_periods(gate_ms=float(text))
+                except ValueError:
+                    pass
+                else:
+                    # the fields are updated once the new setting is in effect
+                    return
+            update_timing_labels()
+
+        def measurement_finished(text):
+            if len(text) > 0:
+                try:
+                    set_periods(measurement_ms=float(text))
+                except ValueError:
+                    pass
+                else:
+                    # the fields are updated once the new setting is in effect
+                    return
+            update_timing_labels()
+
+        def adaptive_changed(checked):
+            self.quartzcam.adaptive_gate = checked
+
+        def update_timing_labels():
+            timing = self.quartzcam.timing_info()
+            gate_field.text = '{:g}'.format(timing['gate_time'] * 1e3)
+            measurement_field.text = '{:g}'.format(timing['measurement_time'] * 1e3)
+            resolution = timing['thickness_resolution']
+            timing_label.text = '{:.1f} Hz, {:.3g} Hz ({} A)'.format(
+                timing['sample_rate'], timing['frequency_resolution'],
+                '--' if resolution is None else '{:.3g}'.format(resolution))
 
         column = ui.create_column_widget()
         
@@ -199,6 +788,48 @@ class QuartzControllerPanelDelegate(object):
         parameters_row.add_spacing(5)
         parameters_row.add_stretch()
         
+        rate_row = ui.create_row_widget()
+        rate_row.add_spacing(5)
+        rate_row.add(ui.create_label_widget('Rate from: '))
+        rate_estimator_combo = ui.create_combo_box_widget(list(rates.ESTIMATORS.keys()))
+        rate_estimator_combo.current_item = self.quartzcam.rate_estimator.name
+        rate_estimator_combo.on_current_item_changed = rate_estimator_changed
+        rate_row.add(rate_estimator_combo)
+        rate_row.add_spacing(10)
+        rate_row.add(ui.create_label_widget('Window (s): '))
+        rate_window_field = ui.create_line_edit_widget()
+        rate_window_field.on_editing_finished = rate_window_finished
+        rate_row.add(rate_window_field)
+        rate_row.add_spacing(5)
+        rate_row.add_stretch()
+        
+        gate_row = ui.create_row_widget()
+        gate_row.add_spacing(5)
+        gate_row.add(ui.create_label_widget('Gate (ms): '))
+        gate_field = ui.create_line_edit_widget()
+        gate_field.on_editing_finished = gate_finished
+        gate_row.add(gate_field)
+        gate_row.add_spacing(10)
+        gate_row.add(ui.create_label_widget('Period (ms): '))
+        measurement_field = ui.create_line_edit_widget()
+        measurement_field.on_editing_finished = measurement_finished
+        gate_row.add(measurement_field)
+        gate_row.add_spacing(10)
+        adaptive_check_box = ui.create_check_box_widget('Adaptive')
+        adaptive_check_box.checked = self.quartzcam.adaptive_gate
+        adaptive_check_box.on_checked_changed = adaptive_changed
+        gate_row.add(adaptive_check_box)
+        gate_row.add_spacing(5)
+        gate_row.add_stretch()
+
+        timing_row = ui.create_row_widget()
+        timing_row.add_spacing(5)
+        timing_row.add(ui.create_label_widget('Sample rate, resolution: '))
+        timing_label = ui.create_label_widget('--')
+        timing_row.add(timing_label)
+        timing_row.add_spacing(5)
+        timing_row.add_stretch()
+
         info_row = ui.create_row_widget()
         info_row.add_spacing(5)
         info_row.add(ui.create_label_widget('Thickness: '))
@@ -219,6 +850,10 @@ class QuartzControllerPanelDelegate(object):
         frequency_label = ui.create_label_widget('--')
         frequency_row.add(frequency_label)
         frequency_row.add(ui.create_label_widget(' Hz'))
+        frequency_row.add_spacing(10)
+        frequency_row.add(ui.create_label_widget('Status: '))
+        status_label = ui.create_label_widget(self.quartzcam.connection_state)
+        frequency_row.add(status_label)
         frequency_row.add_spacing(5)
         frequency_row.add_stretch()
         
@@ -227,6 +862,12 @@ class QuartzControllerPanelDelegate(object):
         column.add_spacing(5)
         column.add(parameters_row)
         column.add_spacing(5)
+        column.add(rate_row)
+        column.add_spacing(5)
+        column.add(gate_row)
+        column.add_spacing(5)
+        column.add(timing_row)
+        column.add_spacing(5)
         column.add(info_row)
         column.add_spacing(5)
         column.add(frequency_row)
@@ -236,8 +877,18 @@ class QuartzControllerPanelDelegate(object):
         density_finished('')
         z_ratio_finished('')
         time_finished('')
+        rate_window_finished('')
         
-        self.quartzcam.update_info_function = update_info_labels
+        # only the latest values are shown, so fast sampling cannot flood the UI task queue
+        info_publisher = publisher.CoalescingPublisher(self.__api.queue_task, update_info_labels,
+                                                       self.info_refresh_rate)
+        status_publisher = publisher.CoalescingPublisher(self.__api.queue_task, update_status_label, None)
+        timing_publisher = publisher.CoalescingPublisher(self.__api.queue_task, update_timing_labels, None)
+        self.publishers = [info_publisher, status_publisher, timing_publisher]
+        self.quartzcam.update_info_function = info_publisher.publish
+        self.quartzcam.on_connection_state_changed = status_publisher.publish
+        self.quartzcam.on_periods_changed = timing_publisher.publish
+        update_timing_labels()
 
         return column
 
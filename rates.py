@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming deposition rate estimators.
+
+All estimators are fed one (timestamp, thickness) sample at a time with update() and do constant work per sample, so
+they can run in the acquisition path at high sample rates.
+"""
+
+import math
+import collections
+
+
+class TwoPointRate(object):
+    """ Difference of the last two samples """
+    name = 'Two-point'
+
+    def __init__(self, window=None):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.rate = 0
+        self._last = None
+
+    def update(self, timestamp, value):
+        if self._last is not None and timestamp > self._last[0]:
+            self.rate = (value - self._last[1]) / (timestamp - self._last[0])
+        self._last = (timestamp, value)
+        return self.rate
+
+    def update_many(self, timestamps, values):
+        for timestamp, value in zip(timestamps, values):
+            self.update(timestamp, value)
+        return self.rate
+
+
+class EMARate(TwoPointRate):
+    """ Exponential moving average of the two-point rate with time constant window (s) """
+    name = 'EMA'
+
+    def __init__(self, window=10.0):
+        super().__init__(window)
+
+    def update(self, timestamp, value):
+        if self._last is not None and timestamp > self._last[0]:
+            dt = timestamp - self._last[0]
+            rate = (value - self._last[1]) / dt
+            if self._initialized:
+                alpha = 1 - math.exp(-dt / self.window) if self.window > 0 else 1
+                self.rate += alpha * (rate - self.rate)
+            else:
+                self.rate = rate
+                self._initialized = True
+        self._last = (timestamp, value)
+        return self.rate
+
+    def reset(self):
+        super().reset()
+        self._initialized = False
+
+
+class LeastSquaresRate(TwoPointRate):
+    """ Least squares slope over the samples of the last window seconds
+
+    The fit is maintained with running sums that are updated when samples enter or leave the window. Times and values
+    are taken relative to a reference sample to keep the sums well conditioned, and the sums are recomputed from the
+    window every time the whole window has been replaced to stop rounding errors from accumulating.
+    """
+    name = 'Least squares'
+
+    def __init__(self, window=10.0, max_samples=None):
+        self.max_samples = max_samples
+        super().__init__(window)
+
+    def reset(self):
+        super().reset()
+        self._samples = collections.deque()
+        self._reference = None
+        self._removed = 0
+        self._n = 0
+        self._st = self._sv = self._stt = self._stv = 0.0
+
+    def _add(self, t, v, sign):
+        self._n += sign
+        self._st += sign * t
+        self._sv += sign * v
+        self._stt += sign * t * t
+        self._stv += sign * t * v
+
+    def _rebase(self):
+        self._reference = self._samples[0] if self._samples else None
+        self._n = 0
+        self._st = self._sv = self._stt = self._stv = 0.0
+        self._removed = 0
+        t0, v0 = self._reference or (0, 0)
+        for t, v in self._samples:
+            self._add(t - t0, v - v0, 1)
+
+    def update(self, timestamp, value):
+        if self._reference is None:
+            self._reference = (timestamp, value)
+        t0, v0 = self._reference
+        self._samples.append((timestamp, value))
+        self._add(timestamp - t0, value - v0, 1)
+        while len(self._samples) > 2 and (timestamp - self._samples[0][0] > self.window or
+                                          (self.max_samples is not None and len(self._samples) > self.max_samples)):
+            t, v = self._samples.popleft()
+            self._add(t - t0, v - v0, -1)
+            self._removed += 1
+        if self._removed >= len(self._samples):
+            self._rebase()
+        denominator = self._n * self._stt - self._st * self._st
+        if self._n > 1 and denominator > 0:
+            self.rate = (self._n * self._stv - self._st * self._sv) / denominator
+        return self.rate
+
+
+ESTIMATORS = collections.OrderedDict((estimator.name, estimator) for estimator in
+                                     (LeastSquaresRate, EMARate, TwoPointRate))
+
+
+def create_estimator(name, window=10.0):
+    """ creates the rate estimator registered under name in ESTIMATORS """
+    return ESTIMATORS[name](window)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Append-only binary log of raw QPOD readings.
+
+A log file consists of a 64 byte header followed by fixed-width little-endian records (see RECORD_DTYPE). Records are
+only ever appended, so a crash can at most leave a partial record at the end, which the reader ignores and the
+recorder truncates when it reopens the file. read_log maps a file straight into a numpy structured array.
+"""
+
+import os
+import struct
+import threading
+import numpy as np
+
+MAGIC = b'QPODLOG\x00'
+VERSION = 1
+HEADER_SIZE = 64
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('counts', '<f8'), ('frequency', '<f8'), ('thickness', '<f8'),
+                         ('density', '<f4'), ('z_ratio', '<f4')])
+
+
+def _make_header():
+    header = MAGIC + struct.pack('<II', VERSION, RECORD_DTYPE.itemsize)
+    return header.ljust(HEADER_SIZE, b'\x00')
+
+
+def _check_header(header, path):
+    if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a QPOD log file.'.format(path))
+    version, record_size = struct.unpack_from('<II', header, len(MAGIC))
+    if version != VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError('Unsupported QPOD log version {:d} (record size {:d}) in {}.'.format(version, record_size,
+                                                                                             path))
+
+
+def read_log(path):
+    """ maps a log file into a read-only numpy structured array without copying the records """
+    with open(path, 'rb') as f:
+        _check_header(f.read(HEADER_SIZE), path)
+    n = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(n,))
+
+
+class LogRecorder(object):
+    """ Streams records into a log file without blocking the caller
+
+    Records are collected in preallocated chunks of chunk_size records. A writer thread appends all filled chunks to
+    the file every flush_interval seconds (or as soon as a chunk is full) and fsyncs after each batch. Appending to an
+    existing log continues it.
+    """
+    def __init__(self, path, flush_interval=1.0, chunk_size=65536):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.records_written = 0
+        self._file = self._open(path)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._buffer = np.empty(chunk_size, dtype=RECORD_DTYPE)
+        self._count = 0
+        self._pending = []
+        self._spare = []
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, name='QPOD log writer', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _open(path):
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            f = open(path, 'r+b')
+            _check_header(f.read(HEADER_SIZE), path)
+            # drop a partial record left behind by a crash
+            size = os.path.getsize(path)
+            f.truncate(size - (size - HEADER_SIZE) % RECORD_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+        else:
+            f = open(path, 'wb')
+            f.write(_make_header())
+            f.flush()
+            os.fsync(f.fileno())
+        return f
+
+    def _next_chunk(self):
+        # must be called with self._lock held, an empty chunk is kept
+        if self._count == 0:
+            return
+        self._pending.append((self._buffer, self._count))
+        self._buffer = self._spare.pop() if self._spare else np.empty(self.chunk_size, dtype=RECORD_DTYPE)
+        self._count = 0
+
+    def append(self, timestamp, counts, frequency, thickness, density, z_ratio):
+        with self._lock:
+            if self._count == self.chunk_size:
+                self._next_chunk()
+                self._wakeup.set()
+            self._buffer[self._count] = (timestamp, counts, frequency, thickness, density, z_ratio)
+            self._count += 1
+
+    def extend(self, timestamps, counts, frequencies, thickness, density, z_ratio):
+        """ appends arrays of samples, density and z_ratio may be scalars """
+        n = len(timestamps)
+        start = 0
+        with self._lock:
+            while start < n:
+                if self._count == self.chunk_size:
+                    self._next_chunk()
+                    self._wakeup.set()
+                k = min(n - start, self.chunk_size - self._count)
+                chunk = self._buffer[self._count:self._count+k]
+                chunk['timestamp'] = timestamps[start:start+k]
+                chunk['counts'] = counts[start:start+k]
+                chunk['frequency'] = frequencies[start:start+k]
+                chunk['thickness'] = thickness[start:start+k]
+                chunk['density'] = density if np.ndim(density) == 0 else density[start:start+k]
+                chunk['z_ratio'] = z_ratio if np.ndim(z_ratio) == 0 else z_ratio[start:start+k]
+                self._count += k
+                start += k
+
+    def flush(self):
+        """ writes all collected records to disk and fsyncs the file """
+        with self._write_lock:
+            with self._lock:
+                self._next_chunk()
+                chunks = self._pending
+                self._pending = []
+            if not chunks:
+                return
+            for buffer, count in chunks:
+                self._file.write(buffer[:count].data)
+                self.records_written += count
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            with self._lock:
+                self._spare.extend(buffer for buffer, count in chunks)
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Writing QPOD log failed. Reason: {}".format(str(e)))
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay of recorded QPOD readings.
+
+ReplayQPOD plugs in where quartz.QPOD does and plays back a recorded sequence of (timestamp, raw count) pairs, e.g. a
+log written by recorder.LogRecorder or by the record command of quartz.py. Its clock returns the recorded time, so a
+Camera using it sees the deposition as it happened:
+
+    qpod = replay.ReplayQPOD.from_log('deposition.qpodlog', speed=100)
+    camera = quartzcam.Camera(qpod=qpod, poll_interval=0)
+
+speed=None plays as fast as the consumer takes the samples, which allows benchmarking the display pipeline against
+hours of data in seconds.
+"""
+
+import time
+import threading
+import numpy as np
+
+try:
+    from . import quartz
+    from . import recorder
+except ImportError:
+    # imported as a plain module like 'python quartz.py' does
+    import quartz
+    import recorder
+
+
+class ReplayQPOD(quartz.QPODBase):
+    """ Plays back recorded readings with the interface of quartz.QPOD
+
+    speed: 1 plays in real time, 100 a hundred times faster, None as fast as possible
+    loop: starts over at the end of the recording (with timestamps continuing), otherwise reading past the end raises
+    a QPODError and sets finished
+    max_queued: when playing as fast as possible, polling pauses while this many samples wait in self.samples
+    """
+    def __init__(self, timestamps, counts, speed=1.0, loop=False, max_queued=100000):
+        super().__init__()
+        self._timestamps = np.asarray(timestamps, dtype=np.float64)
+        self._counts = np.asarray(counts, dtype=np.float64)
+        if len(self._timestamps) == 0 or len(self._timestamps) != len(self._counts):
+            raise ValueError('A replay needs the same non-zero number of timestamps and counts.')
+        self.speed = speed
+        self.loop = loop
+        self.max_queued = max_queued
+        self.samples = quartz.SampleQueue(max_queued)
+        self.on_sample = None
+        self.poller = None
+        self.status = quartz.QPODStatus.ok
+        self.timeout = 1.0
+        self.failures = 0
+        self.serialport = None
+        self.finished = threading.Event()
+        self.clock = self._clock
+        self._lock = threading.Lock()
+        self._opened = False
+        self._position = 0
+        # added to the recorded timestamps, grows by the duration of the recording with every loop
+        self._offset = 0
+        self._current_time = self._timestamps[0]
+        self._wall_start = time.monotonic()
+        self._stop = threading.Event()
+        self._poll_thread = None
+        self._poll_stop = threading.Event()
+
+    @classmethod
+    def from_log(cls, path, **kwargs):
+        """ replays a binary log written by recorder.LogRecorder """
+        log = recorder.read_log(path)
+        return cls(log['timestamp'], log['counts'], **kwargs)
+
+    @classmethod
+    def from_csv(cls, path, **kwargs):
+        """ replays a CSV file with timestamp and counts columns as written by 'quartz.py record'
+
+        Older recordings rounded the counts to integers, for those the counts are recomputed from the frequency column
+        (at the default gate period like the replay uses). Rounded counts without a frequency column raise a ValueError.
+        """
+        data = np.genfromtxt(path, delimiter=',', names=True)
+        counts = data['counts']
+        if np.all(counts == np.round(counts)):
+            if 'frequency' not in data.dtype.names:
+                raise ValueError('The counts in {} are rounded and there is no frequency column.'.format(path))
+            counts = 200.0 * float(quartz.GATEPERIOD) / data['frequency']
+        return cls(data['timestamp'], counts, **kwargs)
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    @property
+    def position(self):
+        """ index of the next sample to be played """
+        return self._position
+
+    def _clock(self):
+        """ returns the recorded time the replay is at """
+        if self.speed is None or not self._opened:
+            return self._current_time
+        return self._timestamps[0] + (time.monotonic() - self._wall_start) * self.speed
+
+    def openconnection(self, serialport=None):
+        """ starts the replay from the beginning """
+        self.serialport = serialport
+        with self._lock:
+            self._position = 0
+            self._offset = 0
+            self._current_time = self._timestamps[0]
+            self._wall_start = time.monotonic()
+            self._opened = True
+        self._stop.clear()
+        self.finished.clear()
+        return True
+
+    @property
+    def connected(self):
+        return self._opened
+
+    def closeconnection(self):
+        self.stop_polling()
+        self._stop.set()
+        self._opened = False
+
+    def set_periods(self, gateperiod=None, measurementperiod=None):
+        raise quartz.QPODError('The gate period of a recording cannot be changed.')
+
+    def _take(self, n):
+        # returns the next n recorded (timestamps, counts), fewer at the end of the recording
+        with self._lock:
+            if not self._opened:
+                raise quartz.QPODError('Replay is not started.')
+            timestamps = []
+            counts = []
+            while n > 0:
+                if self._position >= len(self._timestamps):
+                    if not self.loop:
+                        break
+                    duration = self._timestamps[-1] - self._timestamps[0]
+                    self._offset += duration + (duration / (len(self._timestamps) - 1) if len(self._timestamps) > 1
+                                                else 1)
+                    self._position = 0
+                stop = min(self._position + n, len(self._timestamps))
+                timestamps.append(self._timestamps[self._position:stop] + self._offset)
+                counts.append(self._counts[self._position:stop])
+                n -= stop - self._position
+                self._position = stop
+            if not timestamps:
+                self.finished.set()
+                raise quartz.QPODError('End of the recording reached.')
+            timestamps = np.concatenate(timestamps)
+            if self.speed is None:
+                self._current_time = timestamps[-1]
+            return timestamps, np.concatenate(counts)
+
+    def _wait_until(self, timestamp):
+        # waits until the replay clock reaches timestamp
+        if self.speed is not None:
+            delay = (timestamp - self._timestamps[0]) / self.speed - (time.monotonic() - self._wall_start)
+            if delay > 0:
+                self._stop.wait(delay)
+
+    def readsamples(self, n, depth=8):
+        """ plays the next n samples and returns (timestamps, counts, frequencies) arrays """
+        timestamps, counts = self._take(n)
+        self._wait_until(timestamps[-1])
+        frequencies = quartz.counts_to_frequency(counts, self.gateperiod)
+        on_sample = self.on_sample
+        if callable(on_sample):
+            for sample in zip(timestamps, counts, frequencies):
+                on_sample(sample)
+        return timestamps, counts, frequencies
+
+    def readmeasurements(self, n, interval=None):
+        """ plays the next n samples, every recorded sample is a measurement so interval is ignored """
+        return self.readsamples(n)
+
+    def readsample(self):
+        """ returns the next (timestamp, raw count, frequency) tuple """
+        timestamps, counts, frequencies = self.readsamples(1)
+        return (float(timestamps[0]), float(counts[0]), float(frequencies[0]))
+
+    def readcounts(self):
+        return self.readsample()[1]
+
+    def readthickness(self, return_freq=False):
+        freq = self.readsample()[2]
+        thickness = self.thickness(freq)
+        if return_freq:
+            return (thickness, freq)
+        else:
+            return thickness
+
+    @property
+    def polling(self):
+        return self._poll_thread is not None and self._poll_thread.is_alive()
+
+    def start_polling(self, interval=0, burst=1):
+        """ plays the recording into self.samples from a worker thread
+
+        In real or accelerated time the samples are queued when their recorded time is reached, interval is ignored.
+        """
+        if self.polling:
+            return
+        self._poll_stop.clear()
+        self._poll_thread = threading.Thread(target=self._poll_loop, args=(burst,), name='QPOD replay', daemon=True)
+        self._poll_thread.start()
+
+    def stop_polling(self, timeout=5):
+        self._poll_stop.set()
+        self._stop.set()
+        if self._poll_thread is not None:
+            self._poll_thread.join(timeout)
+        self._poll_thread = None
+        if self._opened:
+            self._stop.clear()
+
+    def _poll_loop(self, burst):
+        # as fast as possible the samples are played in large chunks, the queue limit keeps them from being dropped,
+        # in real or accelerated time all samples that are due are played at once
+        chunk = max(burst, 1024)
+        while not self._poll_stop.is_set():
+            if self.speed is None:
+                if len(self.samples) + chunk > self.max_queued:
+                    self._poll_stop.wait(0.001)
+                    continue
+            else:
+                due = np.searchsorted(self._timestamps, self.clock() - self._offset, side='right') - self._position
+                chunk = int(min(max(due, burst, 1), self.max_queued))
+            try:
+                self.samples.extend(zip(*self.readsamples(chunk)))
+            except quartz.QPODError:
+                # stay in polling mode at the end, so a camera keeps showing the recording instead of reading
+                self._poll_stop.wait()
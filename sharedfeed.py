@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live thickness feed in shared memory for other processes.
+
+Only one process can open the QPOD serial port. The acquisition side therefore publishes every reading into a
+multiprocessing.shared_memory block that any number of local processes can map:
+
+    reader = sharedfeed.FeedReader('quartzpy')
+    timestamp, thickness, rate, frequency = reader.latest()
+    position, records = reader.read_since(position)
+
+The block holds a header and a ring of FEED_DTYPE records. The writer increments a sequence counter before and after
+every update (seqlock), so the counter is odd while an update is in progress. Readers never block the writer: they
+copy what they need and retry if the counter changed meanwhile.
+"""
+
+import struct
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+MAGIC = b'QPODFEED'
+VERSION = 1
+FEED_DTYPE = np.dtype([('timestamp', '<f8'), ('thickness', '<f8'), ('rate', '<f8'), ('frequency', '<f8')])
+# magic, version, capacity, then the fields of HEADER_DTYPE
+HEADER_PREFIX = struct.Struct('<8sII')
+HEADER_DTYPE = np.dtype([('sequence', '<u8'), ('written', '<u8'), ('timestamp', '<f8'), ('thickness', '<f8'),
+                         ('rate', '<f8'), ('frequency', '<f8'), ('density', '<f8'), ('z_ratio', '<f8')])
+HEADER_SIZE = 128
+
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name)
+    try:
+        # before Python 3.13 the resource tracker would remove the block when a reader exits
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+class _Feed(object):
+    def _map(self, shm, capacity):
+        self._shm = shm
+        self.capacity = capacity
+        self._header = np.ndarray((), dtype=HEADER_DTYPE, buffer=shm.buf, offset=HEADER_PREFIX.size)
+        self._ring = np.ndarray((capacity, ), dtype=FEED_DTYPE, buffer=shm.buf, offset=HEADER_SIZE)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def written(self):
+        """ total number of records written since the feed was created """
+        return int(self._header['written'])
+
+    def close(self):
+        # the views have to go before the memory can be unmapped
+        self._header = None
+        self._ring = None
+        self._shm.close()
+
+
+class FeedWriter(_Feed):
+    """ Creates the shared memory block name with room for capacity records and publishes readings into it
+
+    An existing block of the same name (e.g. left over from a crashed session) is replaced.
+    """
+    def __init__(self, name='quartzpy', capacity=2**16):
+        capacity = int(capacity)
+        size = HEADER_SIZE + capacity * FEED_DTYPE.itemsize
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            old = _attach(name)
+            old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        HEADER_PREFIX.pack_into(shm.buf, 0, MAGIC, VERSION, capacity)
+        self._map(shm, capacity)
+        self._header[()] = 0
+
+    def publish(self, timestamps, thickness, frequencies, rate, density=1, z_ratio=1):
+        """ appends arrays of readings (a single rate for all of them) and updates the latest values """
+        n = len(timestamps)
+        if n == 0:
+            return
+        header = self._header
+        ring = self._ring
+        start = int(header['written'])
+        if n > self.capacity:
+            timestamps, thickness, frequencies = timestamps[-self.capacity:], thickness[-self.capacity:], \
+                                                 frequencies[-self.capacity:]
+            start += n - self.capacity
+            n = self.capacity
+        header['sequence'] += 1
+        index = start % self.capacity
+        first = min(n, self.capacity - index)
+        for records, part in ((ring[index:index+first], slice(0, first)), (ring[:n-first], slice(first, n))):
+            records['timestamp'] = timestamps[part]
+            records['thickness'] = thickness[part]
+            records['rate'] = rate
+            records['frequency'] = frequencies[part]
+        header['written'] = start + n
+        header['timestamp'] = timestamps[-1]
+        header['thickness'] = thickness[-1]
+        header['rate'] = rate
+        header['frequency'] = frequencies[-1]
+        header['density'] = density
+        header['z_ratio'] = z_ratio
+        header['sequence'] += 1
+
+    def close(self):
+        """ closes and removes the block, readers that still have it mapped keep working on the last state """
+        shm = self._shm
+        super().close()
+        shm.unlink()
+
+
+class FeedReader(_Feed):
+    """ Maps the feed name created by a FeedWriter """
+    def __init__(self, name='quartzpy'):
+        shm = _attach(name)
+        magic, version, capacity = HEADER_PREFIX.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            shm.close()
+            raise ValueError('{} is not a QPOD feed of version {:d}.'.format(name, VERSION))
+        self._map(shm, capacity)
+
+    def _consistent(self, read, retry_delay=1e-5):
+        # calls read until no update happened while it ran
+        header = self._header
+        while True:
+            sequence = int(header['sequence'])
+            if sequence % 2 == 0:
+                result = read()
+                if int(header['sequence']) == sequence:
+                    return result
+            time.sleep(retry_delay)
+
+    def latest(self):
+        """ returns (timestamp, thickness, rate, frequency) of the latest reading """
+        header = self._header
+        return self._consistent(lambda: (float(header['timestamp']), float(header['thickness']),
+                                         float(header['rate']), float(header['frequency'])))
+
+    def parameters(self):
+        """ returns (density, z_ratio) used for the latest reading """
+        header = self._header
+        return self._consistent(lambda: (float(header['density']), float(header['z_ratio'])))
+
+    def read_since(self, position=0):
+        """ returns (new position, copy of the records written since position)
+
+        position is the value returned by the previous call (0 for everything still in the ring). Records that were
+        overwritten before they could be read are skipped, compare position with written to detect that.
+        """
+        def read():
+            written = int(self._header['written'])
+            first = max(position, written - self.capacity)
+            indices = np.arange(first, written) % self.capacity
+            return written, self._ring[indices]
+        return self._consistent(read)
+
+    def view(self):
+        """ returns the ring as a numpy view without copying, records may change while it is used """
+        return self._ring
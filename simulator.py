@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Simulated QPOD controller on a pseudo-terminal.
+
+The simulator speaks the same ASCII protocol as the real controller ('!A1', '!B<gate>', '!C<period>'), so QPOD and
+Camera can be used without hardware:
+
+    sim = simulator.QPODSimulator(rate=2.0)
+    sim.start()
+    qp = quartz.QPOD()
+    qp.openconnection(sim.port)
+
+The crystal is modelled with z-ratio 1, in which case the z-match formula in quartz.frequency_to_thickness can be
+inverted exactly.
+"""
+
+import os
+import sys
+import time
+import tty
+import select
+import argparse
+import threading
+import numpy as np
+
+try:
+    from . import quartz
+except ImportError:
+    # run as a script (python simulator.py ...) on a machine without Swift
+    import quartz
+
+
+class QPODSimulator(object):
+    """ Simulated QPOD controller serving a pty
+
+    rate: deposition rate in Angstrom/s
+    density: density of the simulated film in g/cm³
+    thickness: film thickness on the crystal when the simulation starts
+    frequency_noise: standard deviation of the measured frequency in Hz at the default gate period. The noise scales
+        inversely with the gate period like the count quantization of the real controller.
+    latency: response latency in seconds
+    clock_hz: clock frequency used to convert gate and measurement periods into seconds
+    """
+    DEFAULT_GATEPERIOD = 2500000
+    DEFAULT_MEASUREMENTPERIOD = 25000000
+
+    def __init__(self, rate=1.0, density=1.0, thickness=0.0, frequency_noise=0.0, latency=0.0, clock_hz=100e6,
+                 seed=None):
+        self.rate = rate
+        self.density = density
+        self.initial_thickness = thickness
+        self.frequency_noise = frequency_noise
+        self.latency = latency
+        self.clock_hz = clock_hz
+        self.gateperiod = self.DEFAULT_GATEPERIOD
+        self.measurementperiod = self.DEFAULT_MEASUREMENTPERIOD
+        self.port = None
+        self.requests = 0
+        self._random = np.random.default_rng(seed)
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._starttime = None
+        self._last_measurement = None
+        self._last_counts = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def thickness(self, t=None):
+        """ returns the simulated film thickness at time t (seconds since start) """
+        if t is None:
+            t = time.time() - self._starttime
+        return self.initial_thickness + self.rate * t
+
+    def frequency(self, thickness):
+        """ returns the crystal frequency for a film thickness (inverse of quartz.frequency_to_thickness for z=1) """
+        k = quartz.AT_CONST * quartz.DENS_QUARZ
+        return k * quartz.FREQ_INIT / (thickness * quartz.FREQ_INIT * self.density + k)
+
+    def counts(self):
+        """ returns the raw count of the most recent completed measurement """
+        t = time.time() - self._starttime
+        period = self.measurementperiod / self.clock_hz
+        index = None
+        if period > 0:
+            index = int(t / period)
+            t = index * period
+        if index is None or index != self._last_measurement:
+            frequency = self.frequency(self.thickness(t))
+            if self.frequency_noise > 0:
+                noise = self.frequency_noise * self.DEFAULT_GATEPERIOD / self.gateperiod
+                frequency += self._random.normal(0, noise)
+            self._last_counts = 200.0 * self.gateperiod / frequency
+            self._last_measurement = index
+        return self._last_counts
+
+    def respond(self, command):
+        """ returns the answer to a single command (without '!' and line ending) """
+        self.requests += 1
+        if command.startswith('A'):
+            return '{:s}{:.9f}'.format(command[:2], self.counts())
+        if command.startswith('B'):
+            self.gateperiod = int(command[1:])
+        elif command.startswith('C'):
+            self.measurementperiod = int(command[1:])
+        return command
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._starttime = time.time()
+        self._last_measurement = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, name='QPOD simulator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _serve(self):
+        buffer = b''
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                buffer += os.read(self._master, 4096)
+            except OSError:
+                break
+            *lines, buffer = buffer.split(b'\n')
+            answers = []
+            for line in lines:
+                line = line.strip()
+                if not line.startswith(b'!'):
+                    continue
+                try:
+                    answers.append(self.respond(line[1:].decode('ASCII')))
+                except ValueError:
+                    answers.append('E')
+            if answers:
+                if self.latency > 0:
+                    time.sleep(self.latency)
+                os.write(self._master, ''.join(answer + '\r\n' for answer in answers).encode('ASCII'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated QPOD controller on a pseudo-terminal')
+    parser.add_argument('--rate', type=float, default=1.0, help='deposition rate in A/s')
+    parser.add_argument('--density', type=float, default=1.0, help='film density in g/cm3')
+    parser.add_argument('--noise', type=float, default=0.0, help='frequency noise in Hz')
+    parser.add_argument('--latency', type=float, default=0.0, help='response latency in s')
+    args = parser.parse_args()
+    sim = QPODSimulator(rate=args.rate, density=args.density, frequency_noise=args.noise, latency=args.latency)
+    sim.start()
+    print('Simulated QPOD listening on {}'.format(sim.port))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()
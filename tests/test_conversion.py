@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the vectorized conversion of raw QPOD counts into frequency and thickness.
+
+The package __init__ needs Nion Swift, so quartz is imported as a plain module like 'python quartz.py' does. Run the
+tests with 'python -m unittest discover tests' from the repository or 'python -m pytest' from this directory.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import quartz
+
+
+def _counts(n, seed=0):
+    # counts of a 6 MHz crystal with up to about 1 um of film at the default gate period
+    frequencies = np.random.default_rng(seed).uniform(5.0e6, 5.999e6, n)
+    return 200.0 * float(quartz.GATEPERIOD) / frequencies
+
+
+class ConversionTest(unittest.TestCase):
+    def test_scalar_and_vector_agree(self):
+        qp = quartz.QPOD()
+        qp.density = 2.7
+        qp.z_ratio = 1.08
+        counts = _counts(1000)
+        thickness, frequencies = qp.convert(counts=counts)
+        for i in range(0, len(counts), 37):
+            frequency = qp.frequency(counts[i])
+            self.assertEqual(frequency, frequencies[i])
+            self.assertEqual(qp.thickness(frequency), thickness[i])
+
+    def test_frequencies_and_counts_give_the_same_thickness(self):
+        qp = quartz.QPOD()
+        counts = _counts(1000)
+        thickness, frequencies = qp.convert(counts=counts)
+        np.testing.assert_array_equal(qp.convert(frequencies=frequencies)[0], thickness)
+
+    def test_out_buffers_are_used_without_allocating(self):
+        n = 2**20
+        counts = _counts(n)
+        thickness_out = np.empty(n, dtype=np.float64)
+        frequency_out = np.empty(n, dtype=np.float64)
+        # warm up, the first call may allocate numpy internals
+        quartz.convert_counts(counts, quartz.GATEPERIOD, 1.3, 1.1, thickness_out, frequency_out)
+        tracemalloc.start()
+        try:
+            thickness, frequencies = quartz.convert_counts(counts, quartz.GATEPERIOD, 1.3, 1.1, thickness_out,
+                                                           frequency_out)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertIs(thickness, thickness_out)
+        self.assertIs(frequencies, frequency_out)
+        # a temporary array would take 8 MB
+        self.assertLess(peak, 64 * 1024)
+
+    def test_throughput(self):
+        n = 2**22
+        counts = _counts(n)
+        thickness_out = np.empty(n, dtype=np.float64)
+        frequency_out = np.empty(n, dtype=np.float64)
+        best = np.inf
+        for i in range(5):
+            start = time.perf_counter()
+            quartz.convert_counts(counts, quartz.GATEPERIOD, 1.3, 1.1, thickness_out, frequency_out)
+            best = min(best, time.perf_counter() - start)
+        self.assertGreater(n / best, 10e6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the ring buffer that keeps the thickness history of the camera.
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import history
+
+
+class WrapAroundTest(unittest.TestCase):
+    def test_appended_samples_keep_the_most_recent_capacity(self):
+        h = history.ThicknessHistory(8)
+        for i in range(37):
+            h.append(float(i), i, error=0.5, frequency=6e6 - i)
+            self.assertEqual(len(h), min(i + 1, 8))
+            self.assertEqual(h.timestamps[-1], i)
+        np.testing.assert_array_equal(h.timestamps, np.arange(29, 37))
+        np.testing.assert_array_equal(h.values, np.arange(29, 37))
+        np.testing.assert_array_equal(h.errors, 0.5)
+        np.testing.assert_array_equal(h.frequencies, 6e6 - np.arange(29, 37))
+        self.assertEqual(h.written, 37)
+
+    def test_extended_samples_keep_the_most_recent_capacity(self):
+        h = history.ThicknessHistory(8)
+        written = 0
+        for n in (3, 5, 7, 1, 20, 0, 6):
+            timestamps = np.arange(written, written + n, dtype=np.float64)
+            h.extend(timestamps, timestamps * 2, frequencies=timestamps)
+            written += n
+            expected = np.arange(max(written - 8, 0), written)
+            np.testing.assert_array_equal(h.timestamps, expected)
+            np.testing.assert_array_equal(h.values, expected * 2)
+            np.testing.assert_array_equal(h.frequencies, expected)
+            np.testing.assert_array_equal(h.errors, 0)
+        self.assertEqual(h.written, written)
+
+    def test_window_after_wrap_around(self):
+        h = history.ThicknessHistory(10)
+        h.extend(np.arange(25.0), np.arange(25.0))
+        timestamps, values = h.window(4)
+        np.testing.assert_array_equal(timestamps, [20, 21, 22, 23, 24])
+        # windows are views on the buffer
+        self.assertIs(timestamps.base, h._timestamps)
+        timestamps, values = h.window(0)
+        np.testing.assert_array_equal(timestamps, np.arange(15, 25))
+
+
+if __name__ == '__main__':
+    unittest.main()
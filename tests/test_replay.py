@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of recording readings from the simulated controller and playing them back with ReplayQPOD.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import quartz
+import replay
+import simulator
+
+
+class CSVRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = simulator.QPODSimulator(rate=1.0, frequency_noise=0.5, seed=0)
+        self.sim.start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'deposition.csv')
+
+    def tearDown(self):
+        self.sim.stop()
+        self.directory.cleanup()
+
+    def test_recorded_counts_replay_the_recorded_frequencies(self):
+        self.assertEqual(quartz.main(['--port', self.sim.port, 'record', self.path, '--duration', '0.5',
+                                      '--rate', '100']), 0)
+        data = np.genfromtxt(self.path, delimiter=',', names=True)
+        self.assertGreater(len(data), 10)
+        # the counts of the controller are fractional
+        self.assertTrue(np.any(data['counts'] % 1 != 0))
+        qp = replay.ReplayQPOD.from_csv(self.path, speed=None)
+        qp.openconnection()
+        timestamps, counts, frequencies = qp.readsamples(len(data))
+        np.testing.assert_array_equal(timestamps, data['timestamp'])
+        np.testing.assert_allclose(frequencies, data['frequency'], rtol=1e-9)
+        np.testing.assert_allclose(frequencies, quartz.FREQ_INIT, rtol=1e-6)
+        thickness, frequencies = qp.convert(frequencies=frequencies)
+        self.assertLess(np.abs(thickness - data['thickness']).max(), 1e-3)
+        self.assertLess(np.abs(thickness).max(), 5)
+
+    def test_rounded_counts_are_recomputed_from_the_frequencies(self):
+        frequencies = np.array([6.0e6, 5.999e6, 5.998e6])
+        counts = 200.0 * float(quartz.GATEPERIOD) / frequencies
+        with open(self.path, 'w') as f:
+            f.write('timestamp,counts,frequency\n')
+            np.savetxt(f, np.column_stack((np.arange(3.0), counts, frequencies)), fmt=('%.6f', '%.0f', '%.9g'),
+                       delimiter=',')
+        qp = replay.ReplayQPOD.from_csv(self.path, speed=None)
+        qp.openconnection()
+        np.testing.assert_allclose(qp.readsamples(3)[2], frequencies, rtol=1e-12)
+
+    def test_rounded_counts_without_frequencies_are_rejected(self):
+        with open(self.path, 'w') as f:
+            f.write('timestamp,counts\n0,83333\n1,83347\n')
+        with self.assertRaises(ValueError):
+            replay.ReplayQPOD.from_csv(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
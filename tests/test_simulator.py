@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the QPOD clients and the camera against the simulated controller.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import quartz
+import quartzcam
+import asyncquartz
+import simulator
+
+
+class GarblingSimulator(simulator.QPODSimulator):
+    """ answers readings with garbage while garbled is set """
+    garbled = False
+
+    def respond(self, command):
+        answer = super().respond(command)
+        if self.garbled and command.startswith('A'):
+            return 'A1xx'
+        return answer
+
+
+class WatchdogTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = GarblingSimulator()
+        self.sim.start()
+        self.qp = quartz.QPOD()
+        self.qp.reconnect_delay = 0.05
+        self.assertTrue(self.qp.openconnection(self.sim.port))
+
+    def tearDown(self):
+        self.qp.closeconnection()
+        self.sim.stop()
+
+    def test_garbled_answers_start_a_reconnect(self):
+        self.qp.readcounts()
+        self.sim.garbled = True
+        for i in range(self.qp.max_failures):
+            with self.assertRaises(quartz.QPODResponseError):
+                self.qp.readcounts()
+        self.assertIs(self.qp.status, quartz.QPODStatus.reconnecting)
+        self.sim.garbled = False
+        deadline = time.monotonic() + 5
+        while self.qp.status is not quartz.QPODStatus.ok and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertIs(self.qp.status, quartz.QPODStatus.ok)
+        self.assertAlmostEqual(self.qp.frequency(self.qp.readcounts()), quartz.FREQ_INIT, delta=100)
+
+
+class BinningTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = simulator.QPODSimulator(rate=0, frequency_noise=0.5, seed=0)
+        self.sim.start()
+        # 10 ms gate and 20 ms measurement period keep the bins short
+        qpod = quartz.QPOD()
+        qpod.gateperiod = '1000000'
+        qpod.measurementperiod = '2000000'
+        self.qpod = qpod
+
+    def tearDown(self):
+        self.camera.stop_live()
+        self.camera.close()
+        self.sim.stop()
+
+    def _acquire(self, poll_interval):
+        self.camera = quartzcam.Camera(serialport=self.sim.port, qpod=self.qpod, poll_interval=poll_interval)
+        self.camera.wait_connected()
+        self.camera.set_exposure_ms(50, 'Run')
+        self.camera.set_binning(4, 'Run')
+        self.camera.start_live()
+        for i in range(4):
+            self.camera.acquire_image()
+        return self.camera.history
+
+    def test_bins_without_polling_spread(self):
+        h = self._acquire(None)
+        self.assertEqual(len(h), 4)
+        # readings of the same measurement would give no spread
+        self.assertTrue(np.all(h.errors > 0))
+
+    def test_polled_bins_are_complete(self):
+        h = self._acquire(0)
+        self.assertGreaterEqual(len(h), 4)
+        self.assertTrue(np.all(h.errors > 0))
+        # every bin covers binning measurement periods
+        self.assertGreater(np.diff(h.timestamps).min(), 3 * self.qpod.measurement_time)
+
+
+class AsyncDisconnectTest(unittest.TestCase):
+    def test_readings_end_with_the_connection(self):
+        sim = simulator.QPODSimulator()
+        sim.start()
+
+        async def read():
+            qp = asyncquartz.AsyncQPOD()
+            await qp.openconnection(sim.port)
+            samples = []
+            try:
+                with self.assertRaises(ConnectionError):
+                    async for sample in qp.readings():
+                        samples.append(sample)
+                        if len(samples) == 5:
+                            sim.stop()
+            finally:
+                await qp.closeconnection()
+            return samples
+
+        try:
+            samples = asyncio.run(asyncio.wait_for(read(), 10))
+        finally:
+            if sim._thread is not None:
+                sim.stop()
+        self.assertEqual(len(samples), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Thickness and rate triggers evaluated on every raw sample.
+
+Triggers are evaluated in the thread that reads the sample from QPOD (the polling worker or the acquisition thread),
+so callbacks fire within milliseconds of the reading instead of once per frame. Callbacks therefore have to return
+quickly, e.g. by toggling a shutter or setting an event.
+"""
+
+import time
+import collections
+import numpy as np
+
+
+class Trigger(object):
+    """ Base class of all triggers
+
+    callback is called as callback(trigger, timestamp, thickness, rate). A trigger with once=True disarms itself after
+    firing, otherwise it re-arms as soon as its condition is no longer met.
+    """
+    def __init__(self, callback, once=True):
+        self.callback = callback
+        self.once = once
+        self.armed = True
+        self.active = False
+        self.fire_count = 0
+        self.last_fired = None
+        self.latencies = collections.deque(maxlen=1000)
+
+    def condition(self, timestamp, thickness, rate):
+        raise NotImplementedError
+
+    def process(self, timestamp, thickness, rate):
+        if not self.armed:
+            return
+        if not self.condition(timestamp, thickness, rate):
+            self.active = False
+            return
+        if self.active:
+            return
+        self.active = True
+        self.fire_count += 1
+        self.last_fired = timestamp
+        if self.once:
+            self.armed = False
+        # time from reading the sample to calling back
+        self.latencies.append(time.time() - timestamp)
+        self.callback(self, timestamp, thickness, rate)
+
+    def rearm(self):
+        self.armed = True
+        self.active = False
+
+
+class ThicknessTrigger(Trigger):
+    """ Fires when the thickness reaches target
+
+    With lead_time > 0 the trigger fires as soon as the crossing is predicted to happen within lead_time seconds at
+    the current rate, which compensates for the reaction time of e.g. a shutter. predicted_time holds the predicted
+    crossing time of the last evaluation. Use falling=True for targets below the current thickness.
+    """
+    def __init__(self, target, callback, lead_time=0, falling=False, once=True):
+        super().__init__(callback, once)
+        self.target = target
+        self.lead_time = lead_time
+        self.falling = falling
+        self.predicted_time = None
+
+    def condition(self, timestamp, thickness, rate):
+        distance = thickness - self.target if self.falling else self.target - thickness
+        if distance <= 0:
+            self.predicted_time = timestamp
+            return True
+        speed = -rate if self.falling else rate
+        if speed > 0:
+            self.predicted_time = timestamp + distance / speed
+            return self.predicted_time - timestamp <= self.lead_time
+        self.predicted_time = None
+        return False
+
+
+class RateTrigger(Trigger):
+    """ Fires when the rate leaves the band [low, high] (None means unbounded) """
+    def __init__(self, low, high, callback, once=False):
+        super().__init__(callback, once)
+        self.low = low
+        self.high = high
+
+    def condition(self, timestamp, thickness, rate):
+        return (self.low is not None and rate < self.low) or (self.high is not None and rate > self.high)
+
+
+class TriggerSet(object):
+    """ Collection of triggers that can be changed from any thread while samples are processed """
+    def __init__(self):
+        self._triggers = ()
+
+    def __len__(self):
+        return len(self._triggers)
+
+    def __iter__(self):
+        return iter(self._triggers)
+
+    def add(self, trigger):
+        self._triggers = self._triggers + (trigger,)
+        return trigger
+
+    def remove(self, trigger):
+        self._triggers = tuple(t for t in self._triggers if t is not trigger)
+
+    def clear(self):
+        self._triggers = ()
+
+    def process(self, timestamp, thickness, rate):
+        for trigger in self._triggers:
+            try:
+                trigger.process(timestamp, thickness, rate)
+            except Exception as e:
+                print("Trigger callback failed. Reason: {}".format(str(e)))
+
+    def latency_stats(self):
+        """ returns min, mean, 99th percentile and max of the trigger-to-callback latencies in s """
+        latencies = np.array([latency for trigger in self._triggers for latency in trigger.latencies])
+        if len(latencies) == 0:
+            return None
+        return {'min': latencies.min(), 'mean': latencies.mean(), 'p99': np.percentile(latencies, 99),
+                'max': latencies.max(), 'count': len(latencies)}